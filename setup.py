@@ -28,5 +28,15 @@ setup(name='WebTestPlus',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
-      tests_require=requires,
-      test_suite="webtest")
+      extras_require={'paste': ['PasteDeploy']},
+      tests_require=requires + ['PasteDeploy'],
+      test_suite="webtest",
+      entry_points="""
+      [console_scripts]
+      webtestplus-load = webtestplus.loader:main
+      webtestplus-bench = webtestplus.bench:main
+      [paste.filter_factory]
+      main = webtestplus:filter_factory
+      [paste.filter_app_factory]
+      middleware = webtestplus:entry_point
+      """)
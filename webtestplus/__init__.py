@@ -35,11 +35,93 @@
 # ***** END LICENSE BLOCK *****
 from webtestplus.override import ClientTesterMiddleware
 from webtestplus.client import TestAppPlus
+from webtestplus.matching import Matcher
+from webtestplus.session import SQLiteRegistry
 
 
-def entry_point(app, global_conf, **options):
-    from paste.deploy.converters import asbool
-    recfile = options['recfile']
-    secret = options.get('secret')
+# options of the middleware, by the name of their converter
+_OPTIONS = {
+    'str': ('mock_path', 'filter_path', 'rec_path', 'batch_path',
+            'metrics_path', 'secret', 'rec_file', 'rec_format',
+            'session_header'),
+    'bool': ('requires_secret', 'rec_fsync', 'rec_compress', 'fast_path',
+             'replay_sequence', 'replay_wrap', 'warm', 'metrics',
+             'rec_namespaces'),
+    'int': ('rec_batch_size', 'rec_max_pending', 'rec_segment_size',
+            'rec_keep_segments', 'rec_keep_bytes', 'max_clients',
+            'max_namespaces', 'rec_max_open', 'replay_inline_max',
+            'shaping_seed'),
+    'float': ('rec_flush_interval', 'rec_segment_age', 'client_ttl'),
+}
+
+# options of the Matcher, prefixed with matcher_
+_MATCHER_OPTIONS = {
+    'bool': ('query', 'json_body', 'fuzzy'),
+    'list': ('ignore_params', 'headers'),
+}
+
+
+def _converters():
+    from paste.deploy.converters import asbool, asint, aslist
+    return {'str': str, 'bool': asbool, 'int': asint, 'float': float,
+            'list': aslist}
+
+
+def _convert(options, table, prefix=''):
+    converters = _converters()
+    converted = {}
+    for kind, names in table.items():
+        for name in names:
+            value = options.pop(prefix + name, None)
+            if value is None or value == '':
+                continue
+            converted[name] = converters[kind](value)
+    return converted
+
+
+def middleware_options(options):
+    """Converts the string options of an ini file into the keyword
+    arguments of ClientTesterMiddleware.
 
-    return cls(app, recfile, secret)
+    backend is "memory" (the default) or "sqlite", with backend_path
+    naming the database shared by the processes. The options of the
+    Matcher are prefixed with "matcher_". Unknown options raise a
+    ValueError.
+    """
+    options = dict(options)
+    if 'recfile' in options:
+        # the name it was first given
+        options.setdefault('rec_file', options.pop('recfile'))
+    kwargs = _convert(options, _OPTIONS)
+    matcher = _convert(options, _MATCHER_OPTIONS, 'matcher_')
+    if matcher:
+        kwargs['matcher'] = Matcher(**matcher)
+
+    backend = options.pop('backend', None) or 'memory'
+    path = options.pop('backend_path', None)
+    if backend == 'sqlite':
+        if not path:
+            raise ValueError('backend_path is required by sqlite')
+        kwargs['backend'] = SQLiteRegistry(
+            path, kwargs.get('max_clients', 10000),
+            kwargs.get('client_ttl', 3600))
+    elif backend != 'memory':
+        raise ValueError('Unknown backend %r' % backend)
+
+    if options:
+        raise ValueError('Unknown options: %s' % ', '.join(sorted(options)))
+    return kwargs
+
+
+def filter_factory(global_conf, **options):
+    """paste.deploy filter factory of ClientTesterMiddleware."""
+    kwargs = middleware_options(options)
+
+    def _filter(app):
+        return ClientTesterMiddleware(app, **kwargs)
+    return _filter
+
+
+def entry_point(app, global_conf, **options):
+    """paste.deploy filter_app factory of ClientTesterMiddleware."""
+    return filter_factory(global_conf, **options)(app)
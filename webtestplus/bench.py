@@ -0,0 +1,225 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Benchmarks of the middleware hot paths.
+
+Each scenario calls the WSGI stack directly, the way a server would, and
+reports requests/sec and latency percentiles in microseconds, along with
+the overhead over the bare application::
+
+    $ python -m webtestplus.bench --threads 1,8 --sizes 100,100000 --json
+"""
+import json
+import optparse
+import os
+import sys
+import tempfile
+import threading
+from timeit import default_timer
+
+from webtest import TestRequest
+from webob import Response
+
+from webtestplus.client import TestAppPlus
+from webtestplus.metrics import percentile
+from webtestplus.override import ClientTesterMiddleware
+from webtestplus.recorder import TEXT, BINARY, dump_text, dump_binary
+
+__all__ = ['run']
+
+SCENARIOS = ('bare', 'passthrough', 'mock', 'record', 'replay')
+_IP = '10.0.0.1'
+_BODY = 'x' * 100
+
+
+def _app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(_BODY)))])
+    return [_BODY]
+
+
+def _start_response(status, headers, exc_info=None):
+    return None
+
+
+def _environ(path):
+    return TestRequest.blank(path, environ={'REMOTE_ADDR': _IP}).environ
+
+
+def measure(app, environs, requests, threads=1):
+    """Calls app requests times from threads threads, cycling through
+    environs, and returns the throughput and latency percentiles."""
+    latencies = []
+    per_thread = max(1, requests // threads)
+
+    def worker():
+        timings = []
+        count = len(environs)
+        for i in xrange(per_thread):
+            environ = dict(environs[i % count])
+            start = default_timer()
+            result = app(environ, _start_response)
+            try:
+                for chunk in result:
+                    pass
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            timings.append(default_timer() - start)
+        latencies.extend(timings)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = default_timer()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = default_timer() - start
+
+    latencies.sort()
+    return {'requests': len(latencies), 'threads': threads,
+            'seconds': seconds, 'rps': len(latencies) / seconds,
+            'p50': percentile(latencies, 50) * 1e6,
+            'p99': percentile(latencies, 99) * 1e6}
+
+
+def _recording(filename, size, format):
+    dump = format == BINARY and dump_binary or dump_text
+    with open(filename, 'wb') as f:
+        for i in xrange(size):
+            req = TestRequest.blank('/replay/%d' % i)
+            f.write(dump(req, Response(body=_BODY)))
+
+
+def _setup(scenario, filename, size, format):
+    """Returns the app and environs to benchmark scenario with."""
+    if scenario == 'bare':
+        return _app, [_environ('/')], None
+
+    if scenario == 'replay':
+        _recording(filename, size, format)
+
+    app = ClientTesterMiddleware(_app, requires_secret=False,
+                                 rec_file=filename, rec_format=format)
+    client = TestAppPlus(app, extra_environ={'REMOTE_ADDR': _IP})
+    environs = [_environ('/')]
+    if scenario == 'mock':
+        client.mock(body=_BODY, repeat=-1)
+    elif scenario == 'record':
+        client.start_recording()
+    elif scenario == 'replay':
+        client.start_replaying()
+        app.warm()
+        environs = [_environ('/replay/%d' % i)
+                    for i in xrange(0, size, max(1, size // 1000))]
+    return app, environs, app.close
+
+
+def run(scenarios=SCENARIOS, requests=10000, threads=(1, 4),
+        sizes=(100, 10000), format=BINARY):
+    """Runs the scenarios with each thread count, and replay with each
+    recording size.
+
+    Returns a list of results, with the overhead of the p50 and p99
+    latencies over the bare application with as many threads.
+    """
+    results = []
+    bare = {}
+    for count in threads:
+        baseline = measure(_app, [_environ('/')], requests, count)
+        bare[count] = baseline['p50'], baseline['p99']
+
+    for scenario in scenarios:
+        for size in scenario == 'replay' and sizes or (None,):
+            for count in threads:
+                fd, filename = tempfile.mkstemp()
+                os.close(fd)
+                app, environs, close = _setup(scenario, filename, size,
+                                              format)
+                try:
+                    result = measure(app, environs, requests, count)
+                finally:
+                    if close is not None:
+                        close()
+                    os.remove(filename)
+
+                result['scenario'] = scenario
+                result['size'] = size
+                result['p50_overhead'] = result['p50'] - bare[count][0]
+                result['p99_overhead'] = result['p99'] - bare[count][1]
+                results.append(result)
+    return results
+
+
+def _ints(value):
+    return tuple(int(item) for item in value.split(','))
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--requests', type='int', default=10000)
+    parser.add_option('-t', '--threads', default='1,4',
+                      help='comma-separated thread counts')
+    parser.add_option('-s', '--sizes', default='100,10000',
+                      help='comma-separated recording sizes, for replay')
+    parser.add_option('-f', '--format', default=BINARY,
+                      choices=[TEXT, BINARY])
+    parser.add_option('-S', '--scenario', action='append',
+                      choices=list(SCENARIOS), dest='scenarios',
+                      help='scenario to run, all by default')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='prints the results as JSON')
+    options, args = parser.parse_args(args)
+
+    results = run(options.scenarios or SCENARIOS, options.requests,
+                  _ints(options.threads), _ints(options.sizes),
+                  options.format)
+    if options.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return 0
+
+    print('%-12s %8s %7s %10s %9s %9s %9s %9s' % (
+        'scenario', 'size', 'threads', 'req/s', 'p50 us', 'p99 us',
+        '+p50 us', '+p99 us'))
+    for result in results:
+        print('%-12s %8s %7d %10.0f %9.1f %9.1f %9.1f %9.1f' % (
+            result['scenario'], result['size'] or '-', result['threads'],
+            result['rps'], result['p50'], result['p99'],
+            result['p50_overhead'], result['p99_overhead']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -36,6 +36,7 @@
 """ Test helpers
 """
 import json
+from contextlib import contextmanager
 from webtest import TestApp
 from webtestplus.override import DISABLED, RECORD, REPLAY
 
@@ -46,24 +47,61 @@ class TestAppPlus(TestApp):
     def __init__(self, app, extra_environ=None, relative_to=None,
                  use_unicode=True, mock_path='/__testing__',
                  filter_path='/__filter__',
-                 rec_path='/__record__', secret=None):
+                 rec_path='/__record__', batch_path='/__batch__',
+                 metrics_path='/__metrics__', secret=None, session=None,
+                 session_header='X-Testing-Session'):
         super(TestAppPlus, self).__init__(app, extra_environ, relative_to,
                                           use_unicode)
         self._mock_path = mock_path
         self._filter_path = filter_path
         self._rec_path = rec_path
+        self._batch_path = batch_path
+        self._metrics_path = metrics_path
+        self._batch = None
         if secret is not None:
             self.extra_environ['HTTP_X_SECRET'] = secret
+        if session is not None:
+            # mocks, filters and recordings of the session are its own
+            key = 'HTTP_' + session_header.upper().replace('-', '_')
+            self.extra_environ[key] = session
+
+    @contextmanager
+    def batch(self):
+        """Collects the mock, filter and recording calls made in the
+        block, and sends them in a single request, applied atomically."""
+        self._batch = []
+        try:
+            yield self
+            ops = self._batch
+        finally:
+            self._batch = None
+
+        if ops:
+            self.post(self._batch_path, params=json.dumps(ops))
+
+    def _queue(self, op, **options):
+        options['op'] = op
+        self._batch.append(options)
+        return True
 
     def rec_status(self):
         return json.loads(self.get(self._rec_path).body)
 
-    def _send_status(self, status):
+    def _send_status(self, status, **options):
+        if self._batch is not None:
+            return self._queue('record', state=status, **options)
+        if options:
+            options['state'] = status
+            status = options
         res = self.post(self._rec_path, params=json.dumps(status))
         return res.status_int == 200
 
-    def start_recording(self):
-        return self._send_status(RECORD)
+    def start_recording(self, rules=None):
+        """Starts recording, only what rules accept if given: see
+        webtestplus.rules.RecordRules."""
+        if rules is None:
+            return self._send_status(RECORD)
+        return self._send_status(RECORD, rules=rules)
 
     def start_replaying(self):
         return self._send_status(REPLAY)
@@ -72,22 +110,45 @@ class TestAppPlus(TestApp):
         return self._send_status(DISABLED)
 
     def del_filters(self):
+        if self._batch is not None:
+            return self._queue('del_filters')
         return self.delete(self._filter_path).status_int == 200
 
     def filter(self, filters):
+        if self._batch is not None:
+            return self._queue('filter', filters=filters)
         filters = json.dumps(filters)
         res = self.post(self._filter_path, params=filters)
         return res.status_int == 200
 
+    def metrics(self):
+        return json.loads(self.get(self._metrics_path).body)
+
+    def del_metrics(self):
+        return self.delete(self._metrics_path).status_int == 200
+
+    def mocks(self):
+        return json.loads(self.get(self._mock_path).body)
+
     def del_mocks(self):
+        if self._batch is not None:
+            return self._queue('del_mocks')
         return self.delete(self._mock_path).status_int == 200
 
-    def mock(self, status=200, body='', headers=None, repeat=1, delay=0.):
+    def mock(self, status=200, body='', headers=None, repeat=1, delay=0.,
+             method=None, path=None):
         if headers is None:
             headers = {}
 
         resp = {'status': status, 'body': body, 'headers': headers,
                 'repeat': repeat, 'delay': delay}
+        if method is not None:
+            resp['method'] = method
+        if path is not None:
+            resp['path'] = path
+
+        if self._batch is not None:
+            return self._queue('mock', **resp)
 
         res = self.post(self._mock_path, params=json.dumps(resp))
         return res.status_int == 200
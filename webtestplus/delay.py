@@ -0,0 +1,92 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Injected latency
+"""
+import time
+
+__all__ = ['Scheduler']
+
+
+class DelayedIter(object):
+    """Wraps an app_iter and waits for a deadline before the first chunk.
+
+    Waiting happens while the server iterates the body, once the wrapped
+    application has returned, so the delay does not hold anything the
+    middleware or the application allocated.
+    """
+    def __init__(self, app_iter, deadline, scheduler):
+        self.app_iter = app_iter
+        self.deadline = deadline
+        self.scheduler = scheduler
+
+    def __iter__(self):
+        self.scheduler.wait_until(self.deadline)
+        for chunk in self.app_iter:
+            yield chunk
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class Scheduler(object):
+    """Clock shared by all the delayed responses of a middleware.
+
+    The default sleep blocks the worker thread. Under gevent or eventlet,
+    pass their sleep (or monkey-patch time) so a delayed response only
+    costs a parked greenlet and thousands of them can wait at once.
+    """
+    def __init__(self, sleep=None, clock=None):
+        self.sleep = sleep or time.sleep
+        self.clock = clock or time.time
+
+    def wait_until(self, deadline):
+        remaining = deadline - self.clock()
+        if remaining > 0:
+            self.sleep(remaining)
+
+    def delay(self, app, seconds):
+        """Returns a WSGI app serving app once seconds have elapsed."""
+        if seconds <= 0:
+            return app
+
+        deadline = self.clock() + seconds
+
+        def delayed(environ, start_response):
+            app_iter = app(environ, start_response)
+            return DelayedIter(app_iter, deadline, self)
+
+        return delayed
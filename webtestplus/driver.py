@@ -0,0 +1,164 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Load driver
+
+Runs virtual clients against an application wrapped by
+ClientTesterMiddleware, each with its own address, mocks and filters::
+
+    driver = LoadDriver(app, clients=50, threads=8)
+    driver.setup(lambda client: client.mock(503, repeat=-1)
+                 if client.index % 10 == 0 else None)
+    print(driver.run(requests=10000))
+"""
+import threading
+from timeit import default_timer
+
+from webtestplus.client import TestAppPlus
+from webtestplus.metrics import percentile
+
+__all__ = ['LoadDriver', 'VirtualClient']
+
+
+def _default_scenario(client):
+    return client.get('/', expect_errors=True)
+
+
+class VirtualClient(TestAppPlus):
+    """A TestAppPlus sending its requests from its own address, through
+    X-Forwarded-For."""
+    def __init__(self, app, index, ip, **options):
+        extra_environ = {'HTTP_X_FORWARDED_FOR': ip, 'REMOTE_ADDR': ip}
+        super(VirtualClient, self).__init__(app, extra_environ, **options)
+        self.index = index
+        self.ip = ip
+
+
+class LoadDriver(object):
+    """Drives clients virtual clients from a pool of threads.
+
+    Each client is only used by one thread, so clients need no locking,
+    and their addresses are prefix.X.Y. options are passed to each
+    TestAppPlus.
+    """
+    def __init__(self, app, clients=10, threads=None, prefix='10.1',
+                 **options):
+        self.app = app
+        self.clients = [VirtualClient(app, index, '%s.%d.%d'
+                                      % (prefix, index // 256, index % 256),
+                                      **options)
+                        for index in range(clients)]
+        self.threads = min(threads or clients, clients)
+
+    def setup(self, func):
+        """Calls func(client) for each client, to set up its mocks,
+        filters or recording."""
+        for client in self.clients:
+            func(client)
+
+    def reset(self):
+        """Removes the mocks and filters of the clients, and stops their
+        recording."""
+        for client in self.clients:
+            with client.batch():
+                client.del_mocks()
+                client.del_filters()
+                client.disable_recording()
+
+    def run(self, requests=1000, duration=None, scenario=None):
+        """Sends requests requests, or as many as possible in duration
+        seconds, spread evenly over the clients.
+
+        scenario(client) sends one request and returns its response; by
+        default it is a GET on /. Returns the throughput, the latency
+        percentiles in milliseconds and the count of each status.
+        """
+        scenario = scenario or _default_scenario
+        latencies = []
+        statuses = {}
+        errors = []
+        lock = threading.Lock()
+        deadline = duration and default_timer() + duration
+
+        def worker(clients, count):
+            timings = []
+            seen = {}
+            failed = 0
+            sent = 0
+            while (deadline and default_timer() < deadline) or \
+                    (not deadline and sent < count):
+                client = clients[sent % len(clients)]
+                sent += 1
+                start = default_timer()
+                try:
+                    resp = scenario(client)
+                except Exception:
+                    failed += 1
+                    continue
+                timings.append(default_timer() - start)
+                status = getattr(resp, 'status_int', None)
+                seen[status] = seen.get(status, 0) + 1
+
+            with lock:
+                latencies.extend(timings)
+                errors.append(failed)
+                for status, number in seen.items():
+                    statuses[status] = statuses.get(status, 0) + number
+
+        workers = []
+        for index in range(self.threads):
+            clients = self.clients[index::self.threads]
+            count = requests // self.threads
+            if index < requests % self.threads:
+                count += 1
+            workers.append(threading.Thread(target=worker,
+                                            args=(clients, count)))
+
+        start = default_timer()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        seconds = default_timer() - start
+
+        latencies.sort()
+        report = {'requests': len(latencies), 'errors': sum(errors),
+                  'seconds': seconds, 'rps': len(latencies) / seconds,
+                  'clients': len(self.clients), 'threads': self.threads,
+                  'statuses': statuses}
+        for percent in 50, 90, 99, 100:
+            report['p%d' % percent] = \
+                percentile(latencies, percent) * 1000 if latencies else None
+        return report
@@ -0,0 +1,251 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Parallel loading of large recordings.
+
+Files are cut in shards at record boundaries and the shards are parsed by
+a pool of processes. The fingerprinted records are sent back in order and
+merged into a ReplayStore, so a replay server can be warmed up before it
+takes traffic::
+
+    $ python -m webtestplus.loader --format binary /path/to/recordings
+"""
+import mmap
+import optparse
+import os
+import sys
+import time
+from multiprocessing import Pool, cpu_count
+
+from webtestplus.matching import Matcher
+from webtestplus.recorder import (TEXT, BINARY, INLINE_MAX, _READERS,
+                                  _HEADER, _MAGIC, _stamp, ReplayStore,
+                                  RecordedResponse)
+
+__all__ = ['shards', 'load']
+
+SHARD_SIZE = 8 * 1024 * 1024
+_TEXT_MARK = '\n--Request:\n'
+
+
+def _binary_bounds(data, size, shard_size):
+    bounds = [0]
+    offset = last = 0
+    while offset + _HEADER.size <= size:
+        magic, _, stored = _HEADER.unpack_from(data, offset)[:3]
+        if magic != _MAGIC:
+            break
+        offset += _HEADER.size + stored
+        if offset - last >= shard_size and offset < size:
+            bounds.append(offset)
+            last = offset
+    return bounds
+
+
+def _text_bounds(data, size, shard_size):
+    # a shard starts on the newline ending the previous record, which is
+    # where the reader stops after a record
+    bounds = [0]
+    offset = shard_size
+    while offset < size:
+        offset = data.find(_TEXT_MARK, offset)
+        if offset == -1:
+            break
+        bounds.append(offset)
+        offset += shard_size
+    return bounds
+
+
+def shards(filename, format=TEXT, shard_size=SHARD_SIZE):
+    """Returns (start, end) offsets cutting filename in shards of about
+    shard_size bytes, on record boundaries.
+
+    Text bodies holding a "--Request:" line can be mistaken for a record
+    boundary: the binary format has no such ambiguity.
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return []
+        if size <= shard_size:
+            return [(0, size)]
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if format == BINARY:
+                bounds = _binary_bounds(data, size, shard_size)
+            else:
+                bounds = _text_bounds(data, size, shard_size)
+        finally:
+            data.close()
+
+    return zip(bounds, bounds[1:] + [size])
+
+
+def _parse(task):
+    """Returns the index entries of a shard, and where parsing stopped.
+
+    Returns None if a shard not starting the file fails to parse: it was
+    cut inside a body.
+    """
+    filename, format, start, end, matcher, inline_max = task
+    if start == 0:
+        return _parse_shard(filename, format, start, end, matcher,
+                            inline_max)
+    try:
+        return _parse_shard(filename, format, start, end, matcher,
+                            inline_max)
+    except Exception:
+        return None
+
+
+def _parse_shard(filename, format, start, end, matcher, inline_max):
+    entries = []
+    offset = start
+    for rec, rec_end in _READERS[format](filename, start, None, inline_max):
+        if offset >= end:
+            break
+        offset = rec_end
+        resp = getattr(rec, 'response', None)
+        if resp is None:
+            continue
+        features = matcher.features(rec)
+        # compressed here so the first replays are not slower
+        variants = resp.body is not None and resp.encode() or None
+        # tuples pickle faster than RecordedResponse
+        entries.append((matcher.route(rec), features,
+                        matcher.fingerprint(rec, features), resp.head,
+                        resp.body, resp.offset, resp.length, variants))
+    return entries, offset
+
+
+def _entries(path, entries):
+    for route, features, key, head, body, offset, length, variants \
+            in entries:
+        if body is None:
+            resp = RecordedResponse(head, None, path, offset, length)
+        else:
+            resp = RecordedResponse(head, body)
+            resp.variants = variants
+        yield route, features, key, resp
+
+
+def load(paths, format=TEXT, matcher=None, inline_max=INLINE_MAX,
+         processes=None, shard_size=SHARD_SIZE):
+    """Parses the recordings in paths, with processes workers.
+
+    Returns a list of (path, entries, offset, stamp), where entries are
+    the arguments of ReplayStore.add in recorded order, offset is where
+    parsing stopped and stamp identifies the version of the file parsed.
+    matcher must be picklable.
+    """
+    if matcher is None:
+        matcher = Matcher()
+    if processes is None:
+        processes = cpu_count()
+
+    tasks = []
+    stamps = []
+    for path in paths:
+        # stat'ed before cutting: a record appended meanwhile is picked up
+        # by the next refresh
+        stamp = _stamp(os.stat(path))
+        path_shards = shards(path, format, shard_size)
+        stamps.append((path, stamp, path_shards))
+        for start, end in path_shards:
+            tasks.append((path, format, start, end, matcher, inline_max))
+
+    if processes > 1 and len(tasks) > 1:
+        pool = Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(_parse, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_parse, tasks)
+
+    loaded = []
+    for path, stamp, path_shards in stamps:
+        count = len(path_shards)
+        path_results = results[:count]
+        del results[:count]
+        if not _chained(path_shards, path_results):
+            # a bound fell inside a body
+            size = path_shards[-1][1]
+            path_results = [_parse((path, format, 0, size, matcher,
+                                    inline_max))]
+        entries = []
+        offset = 0
+        for shard_entries, offset in path_results:
+            entries.extend(_entries(path, shard_entries))
+        loaded.append((path, entries, offset, stamp))
+    return loaded
+
+
+def _chained(path_shards, path_results):
+    """Tells if each shard starts where parsing the previous one stopped."""
+    offset = 0
+    for (start, _), result in zip(path_shards, path_results):
+        if result is None or start != offset:
+            return False
+        offset = result[1]
+    return True
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] PATH',
+        description='Loads a recording file or directory, and reports '
+                    'how long it took.')
+    parser.add_option('-f', '--format', default=TEXT,
+                      choices=[TEXT, BINARY])
+    parser.add_option('-p', '--processes', type='int', default=None,
+                      help='number of workers, one per CPU by default')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('a single PATH is expected')
+
+    store = ReplayStore(args[0], options.format)
+    start = time.time()
+    store.warm(options.processes)
+    elapsed = time.time() - start
+    print('%d fingerprints from %d files in %.2fs'
+          % (len(store), len(store.paths()), elapsed))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
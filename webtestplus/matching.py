@@ -0,0 +1,132 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Replay matching
+"""
+import hashlib
+import json
+from urlparse import parse_qsl
+
+__all__ = ['Matcher']
+
+
+class Matcher(object):
+    """Decides which recorded request answers an incoming one.
+
+    Requests are reduced to a fingerprint: method, path, query string with
+    its parameters sorted, selected headers, and for methods other than GET
+    and DELETE a digest of the body, canonicalized first when it is JSON.
+    Recorded requests are fingerprinted once, when indexed.
+
+    - query: when False, the query string is ignored.
+    - ignore_params: query parameters left out of the fingerprint.
+    - json_body: when True, JSON bodies differing by key order or
+      whitespace match.
+    - headers: names of the headers that must match.
+    - fuzzy: when True and nothing matches exactly, the recorded request
+      to the same method and path sharing the most query parameters,
+      headers and body is used.
+    """
+    def __init__(self, query=True, ignore_params=(), json_body=True,
+                 headers=(), fuzzy=False):
+        self.query = query
+        self.ignore_params = frozenset(ignore_params)
+        self.json_body = json_body
+        self.headers = tuple(name.lower() for name in headers)
+        self.fuzzy = fuzzy
+
+    def _params(self, request):
+        if not self.query or not request.query_string:
+            return ()
+        params = parse_qsl(request.query_string, keep_blank_values=True)
+        return tuple(sorted(param for param in params
+                            if param[0] not in self.ignore_params))
+
+    def _body(self, request):
+        if request.method in ('GET', 'DELETE'):
+            return None
+
+        body = request.body
+        if self.json_body and body[:1] in ('{', '['):
+            try:
+                body = json.dumps(json.loads(body), sort_keys=True,
+                                  separators=(',', ':'))
+            except ValueError:
+                pass
+            else:
+                if isinstance(body, unicode):
+                    body = body.encode('utf8')
+        return hashlib.md5(body).hexdigest()
+
+    def _headers(self, request):
+        if not self.headers:
+            return ()
+        headers = request.headers
+        return tuple(headers.get(name) for name in self.headers)
+
+    def route(self, request):
+        return request.method, request.path_info
+
+    def features(self, request):
+        """Returns what the fingerprint is made of, besides the route."""
+        return self._params(request), self._headers(request), \
+            self._body(request)
+
+    def fingerprint(self, request, features=None):
+        if features is None:
+            features = self.features(request)
+        return self.route(request) + features
+
+    def signature(self):
+        """Identifies the options fingerprints depend on."""
+        return repr((self.query, sorted(self.ignore_params), self.json_body,
+                     self.headers))
+
+    def digest(self, fingerprint):
+        """Returns a fingerprint as a short string, for indexes on
+        disk."""
+        return hashlib.md5(repr(fingerprint)).hexdigest()
+
+    def score(self, asked, stored):
+        """Ranks stored features against asked ones, higher is closer."""
+        params, headers, body = asked
+        stored_params, stored_headers, stored_body = stored
+        score = len(set(params) & set(stored_params))
+        score -= len(set(params) ^ set(stored_params)) * .1
+        score += sum(1 for one, other in zip(headers, stored_headers)
+                     if one == other)
+        if body == stored_body:
+            score += 1
+        return score
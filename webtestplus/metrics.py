@@ -0,0 +1,215 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Counters and latency histograms of the middleware.
+"""
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+
+__all__ = ['Metrics', 'NullMetrics', 'NULL_METRICS', 'percentile']
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1,
+           .25, .5, 1., 2.5, 5., 10.)
+
+# outcomes of a request
+MOCK_HIT = 'mock_hit'
+REPLAY_HIT = 'replay_hit'
+REPLAY_MISS = 'replay_miss'
+RECORDED = 'recorded'
+PASSTHROUGH = 'passthrough'
+
+# client label of the requests of the clients no longer tracked
+OTHERS = '*'
+
+
+def percentile(values, percent):
+    """Returns the percent percentile of sorted values."""
+    return values[min(len(values) - 1, int(len(values) * percent / 100.))]
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns (upper bound, count) pairs, the last bound being
+        +Inf."""
+        total = 0
+        pairs = []
+        for bound, count in zip(BUCKETS + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+
+def _label(value):
+    if value is None:
+        value = ''
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return value.replace('\n', '\\n')
+
+
+def _bound(bound):
+    return bound == float('inf') and '+Inf' or repr(bound)
+
+
+class Metrics(object):
+    """Requests counted by client and outcome, and latencies by stage and
+    outcome.
+
+    Stages are 'request' for the whole handling of a request by the
+    middleware, body excluded, 'app' for the wrapped application, 'mock'
+    for the lookup of a mock, 'replay' for the lookup of a recording,
+    'load' for the parsing of recordings and 'delay' for the delays
+    injected by filters.
+
+    Requests are counted for the max_clients most recently seen clients:
+    the counts of the others are added to those of the OTHERS label.
+    """
+    enabled = True
+
+    def __init__(self, max_clients=10000):
+        self.max_clients = max_clients
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = OrderedDict()
+            self.others = {}
+            self.histograms = {}
+
+    def count(self, client, outcome):
+        requests = self.requests
+        with self.lock:
+            counts = requests.pop(client, None)
+            if counts is None:
+                counts = {}
+                if len(requests) >= self.max_clients:
+                    others = self.others
+                    for key, count in requests.popitem(last=False)[1].items():
+                        others[key] = others.get(key, 0) + count
+            # the most recently seen come last
+            requests[client] = counts
+            counts[outcome] = counts.get(outcome, 0) + 1
+
+    def _counts(self):
+        counts = [(client or '', outcome, count)
+                  for client, outcomes in self.requests.items()
+                  for outcome, count in outcomes.items()]
+        counts.extend((OTHERS, outcome, count)
+                      for outcome, count in self.others.items())
+        return counts
+
+    def observe(self, stage, outcome, seconds):
+        key = stage, outcome
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def as_dict(self):
+        with self.lock:
+            requests = {}
+            for client, outcome, count in self._counts():
+                requests.setdefault(client, {})[outcome] = count
+
+            stages = {}
+            for (stage, outcome), histogram in self.histograms.items():
+                buckets = [[_bound(bound), count]
+                           for bound, count in histogram.cumulative()]
+                stages.setdefault(stage, {})[outcome or ''] = {
+                    'count': histogram.count, 'sum': histogram.sum,
+                    'buckets': buckets}
+        return {'requests': requests, 'stages': stages}
+
+    def as_prometheus(self):
+        """Returns the metrics in the Prometheus text format."""
+        lines = ['# TYPE webtestplus_requests_total counter']
+        with self.lock:
+            for client, outcome, count in sorted(self._counts()):
+                lines.append('webtestplus_requests_total{client="%s",'
+                             'outcome="%s"} %d'
+                             % (_label(client), _label(outcome), count))
+
+            lines.append('# TYPE webtestplus_stage_seconds histogram')
+            for (stage, outcome), histogram in \
+                    sorted(self.histograms.items()):
+                labels = 'stage="%s",outcome="%s"' % (_label(stage),
+                                                      _label(outcome))
+                for bound, count in histogram.cumulative():
+                    lines.append('webtestplus_stage_seconds_bucket{%s,'
+                                 'le="%s"} %d'
+                                 % (labels, _bound(bound), count))
+                lines.append('webtestplus_stage_seconds_sum{%s} %r'
+                             % (labels, histogram.sum))
+                lines.append('webtestplus_stage_seconds_count{%s} %d'
+                             % (labels, histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+class NullMetrics(object):
+    """Stands for Metrics when they are disabled, and records nothing."""
+    enabled = False
+
+    def reset(self):
+        pass
+
+    def count(self, client, outcome):
+        pass
+
+    def observe(self, stage, outcome, seconds):
+        pass
+
+    def as_dict(self):
+        return {'requests': {}, 'stages': {}}
+
+    def as_prometheus(self):
+        return ''
+
+
+NULL_METRICS = NullMetrics()
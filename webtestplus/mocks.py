@@ -0,0 +1,289 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Mocked responses
+"""
+from collections import deque
+from itertools import count
+import httplib
+import threading
+
+__all__ = ['Mock', 'MockQueue', 'match_path', 'status_line']
+
+
+STATUS_LINES = dict((code, '%d %s' % (code, reason))
+                    for code, reason in httplib.responses.items())
+
+
+def status_line(code):
+    """Returns the status line of code, e.g. '401 Unauthorized'."""
+    line = STATUS_LINES.get(code)
+    if line is None:
+        if not 100 <= code < 600:
+            raise ValueError(code)
+        # an unknown code gets the reason of its class
+        reason = httplib.responses.get(code // 100 * 100, 'Unknown')
+        line = '%d %s' % (code, reason)
+    return line
+
+
+def _native(value, encoding='latin-1'):
+    if isinstance(value, unicode):
+        return value.encode(encoding)
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    if not isinstance(value, str):
+        raise TypeError(value)
+    return value
+
+
+class Mock(dict):
+    """A mock spec, compiled once into the status line, header list and
+    body it is served with.
+
+    It is still the spec dict, and a WSGI application serving the mocked
+    response. Raises ValueError or TypeError for invalid specs.
+    """
+    def __init__(self, spec):
+        dict.__init__(self, spec)
+        self.status = status_line(int(self.get('status') or 200))
+        self.body = _native(self.get('body') or '', 'utf8')
+        self.delay = float(self.get('delay') or 0)
+        self.passthrough = bool(self.get('passthrough'))
+        self.repeat = self.get('repeat', 1)
+        if not isinstance(self.repeat, (int, long)) or \
+                isinstance(self.repeat, bool) or self.repeat < -1:
+            raise ValueError(self.repeat)
+        for name in 'method', 'path':
+            if not isinstance(self.get(name), (basestring, type(None))):
+                raise TypeError(self[name])
+
+        headers = self.get('headers') or {}
+        if not isinstance(headers, dict):
+            raise TypeError(headers)
+        self.headers = [(_native(name), _native(value))
+                        for name, value in headers.items()]
+        names = set(name.lower() for name, value in self.headers)
+        headerlist = [header for header in
+                      [('Content-Type', 'text/html; charset=UTF-8')]
+                      if header[0].lower() not in names]
+        headerlist.extend(header for header in self.headers
+                          if header[0].lower() != 'content-length')
+        headerlist.append(('Content-Length', str(len(self.body))))
+        self.headerlist = headerlist
+
+    def __call__(self, environ, start_response):
+        start_response(self.status, list(self.headerlist))
+        return [self.body]
+
+
+def _segments(path):
+    return [segment for segment in path.split('/') if segment]
+
+
+def match_path(pattern, path):
+    """Tells if path matches pattern.
+
+    In a pattern, a * segment matches any single segment, and a trailing
+    * matches one segment or more. A None pattern matches any path.
+    """
+    if pattern is None:
+        return True
+
+    pattern, path = _segments(pattern), _segments(path)
+    for index, segment in enumerate(pattern):
+        if index >= len(path):
+            return False
+        if segment == '*':
+            if index == len(pattern) - 1:
+                return True
+        elif segment != path[index]:
+            return False
+    return len(path) == len(pattern)
+
+
+def _method(spec):
+    method = spec.get('method')
+    if method in (None, '*'):
+        return None
+    return method.upper()
+
+
+class _Entry(object):
+    __slots__ = ('seq', 'spec', 'remaining', 'bucket')
+
+    def __init__(self, seq, spec, remaining, bucket):
+        self.seq = seq
+        self.spec = spec
+        self.remaining = remaining
+        self.bucket = bucket
+
+
+class _Node(object):
+    """A path segment of the mocks index.
+
+    exact holds the entries whose pattern ends here, rest the ones whose
+    pattern ends here with a trailing *. Both are keyed by method, None
+    standing for any method. Each bucket is a deque in serving order.
+    """
+    __slots__ = ('children', 'star', 'exact', 'rest')
+
+    def __init__(self):
+        self.children = {}
+        self.star = None
+        self.exact = {}
+        self.rest = {}
+
+
+class MockQueue(object):
+    """Mocked responses, each with a count of remaining uses.
+
+    A mock added with repeat=N is stored once and served N times. A count
+    of -1 repeats forever: the entry goes back at the end of the queue
+    each time it is served.
+
+    A mock may restrict the requests it answers with a method and a path
+    pattern (see match_path). The patterns are indexed in a trie of path
+    segments, so finding the mock of a request costs a walk along its
+    path, whatever the number of mocks. Among the mocks matching a
+    request, the oldest one is served: mocks without patterns are served
+    in FIFO order as before.
+
+    Each queue has its own lock, so a mock is never served more times
+    than asked, and clients don't contend with each other.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self.lock:
+            self._root = _Node()
+            self._any = {}
+            self._entries = set()
+            self._seq = count()
+
+    def _bucket(self, spec):
+        buckets = self._any
+        path = spec.get('path')
+        if path is not None:
+            node = self._root
+            segments = _segments(path)
+            for index, segment in enumerate(segments):
+                if segment == '*' and index == len(segments) - 1:
+                    buckets = node.rest
+                    break
+                if segment == '*':
+                    if node.star is None:
+                        node.star = _Node()
+                    node = node.star
+                else:
+                    node = node.children.setdefault(segment, _Node())
+            else:
+                buckets = node.exact
+
+        method = _method(spec)
+        bucket = buckets.get(method)
+        if bucket is None:
+            bucket = buckets[method] = deque()
+        return bucket
+
+    def push(self, spec, repeat=1):
+        if repeat == -1 or repeat > 0:
+            with self.lock:
+                bucket = self._bucket(spec)
+                entry = _Entry(next(self._seq), spec, repeat, bucket)
+                bucket.append(entry)
+                self._entries.add(entry)
+
+    def _candidates(self, buckets, method, found):
+        for key in method, None:
+            bucket = buckets.get(key)
+            if bucket:
+                found.append(bucket[0])
+
+    def _walk(self, node, segments, index, method, found):
+        if index == len(segments):
+            self._candidates(node.exact, method, found)
+            return
+
+        self._candidates(node.rest, method, found)
+        child = node.children.get(segments[index])
+        if child is not None:
+            self._walk(child, segments, index + 1, method, found)
+        if node.star is not None:
+            self._walk(node.star, segments, index + 1, method, found)
+
+    def pop(self, method=None, path=None):
+        """Returns the next mock to serve for a request, or None."""
+        if not self._entries:
+            return None
+
+        with self.lock:
+            found = []
+            self._candidates(self._any, method, found)
+            if path is not None:
+                self._walk(self._root, _segments(path), 0, method, found)
+            if not found:
+                return None
+
+            entry = min(found, key=lambda entry: entry.seq)
+            if entry.remaining == -1:
+                entry.bucket.popleft()
+                entry.seq = next(self._seq)
+                entry.bucket.append(entry)
+            elif entry.remaining > 1:
+                entry.remaining -= 1
+            else:
+                entry.bucket.popleft()
+                self._entries.discard(entry)
+            return entry.spec
+
+    def status(self):
+        """Returns a JSON-friendly view of the queue."""
+        mocks = []
+        with self.lock:
+            entries = sorted(self._entries, key=lambda entry: entry.seq)
+        for entry in entries:
+            mock = {'status': entry.spec.get('status'),
+                    'remaining': entry.remaining}
+            for option in ('method', 'path'):
+                if entry.spec.get(option) is not None:
+                    mock[option] = entry.spec[option]
+            mocks.append(mock)
+        return {'length': len(mocks), 'mocks': mocks}
@@ -35,37 +35,38 @@
 # ***** END LICENSE BLOCK *****
 """ Test helpers
 """
-from collections import defaultdict
 import json
-import time
-import threading
 import tempfile
 import os
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+from functools import partial
+from hashlib import md5
+from timeit import default_timer
+from urllib import quote
 
 from webob.dec import wsgify
 from webob import exc
 
-from webtestplus.recorder import get_record
+from webtestplus.matching import Matcher
+from webtestplus.recorder import (ReplayStore, TEXT, BINARY, INLINE_MAX,
+                                  response_head, text_pieces, binary_pieces)
+from webtestplus.delay import Scheduler
+from webtestplus.shaping import Shaper, check_shape
+from webtestplus.writer import (RecordWriter, SegmentedWriter, SharedWriter,
+                                TeeIter)
+from webtestplus.mocks import Mock, MockQueue
+from webtestplus.rules import RecordRules, HASH
+from webtestplus.metrics import (Metrics, NULL_METRICS, MOCK_HIT, REPLAY_HIT,
+                                 REPLAY_MISS, RECORDED, PASSTHROUGH)
+from webtestplus.session import SessionRegistry, DISABLED, RECORD, REPLAY
 
 
 __all__ = ['ClientTesterMiddleware']
 
-
-DISABLED = 'disabled'
-RECORD = 'recording'
-REPLAY = 'playing'
-
-
-
-def _int2status(status):
-    if status == 200:
-        return '200 OK'
-    if status == 400:
-        return '400 Bad Request'
-    if status == '401':
-        return '400 Unauthorized'
-
-    return '%d Explanation' % status
+# rules of a client left as they are
+_KEEP = object()
 
 
 class ClientTesterMiddleware(object):
@@ -74,25 +75,105 @@ class ClientTesterMiddleware(object):
     def __init__(self, app, mock_path='/__testing__',
                  filter_path='/__filter__',
                  rec_path='/__record__',
+                 batch_path='/__batch__',
+                 metrics_path='/__metrics__',
                  secret='CHANGEME',
                  requires_secret=True,
-                 rec_file=None):
-        self.custom_paths = mock_path, filter_path, rec_path
+                 rec_file=None,
+                 sleep=None,
+                 rec_flush_interval=1.,
+                 rec_batch_size=100,
+                 rec_fsync=False,
+                 rec_max_pending=1000,
+                 rec_format=TEXT,
+                 rec_compress=False,
+                 rec_segment_size=None,
+                 rec_segment_age=None,
+                 rec_keep_segments=None,
+                 rec_keep_bytes=None,
+                 max_clients=10000,
+                 client_ttl=3600,
+                 fast_path=True,
+                 backend=None,
+                 matcher=None,
+                 replay_sequence=True,
+                 replay_wrap=False,
+                 replay_inline_max=INLINE_MAX,
+                 warm=False,
+                 metrics=False,
+                 session_header='X-Testing-Session',
+                 rec_namespaces=False,
+                 max_namespaces=1000,
+                 rec_max_open=32,
+                 shaping_seed=None):
+        self.custom_paths = (mock_path, filter_path, rec_path, batch_path,
+                             metrics_path)
         self.app = app
         self.mock_path = mock_path
         self.filter_path = filter_path
         self.rec_path = rec_path
-        self.replays = defaultdict(list)
-        self.filters = defaultdict(dict)
-        self.is_recording = defaultdict(lambda: DISABLED)
-        self.lock = threading.RLock()
-        if rec_file is None:
+        self.batch_path = batch_path
+        self.metrics_path = metrics_path
+        self.metrics = metrics and Metrics(max_clients) or NULL_METRICS
+        if backend is None:
+            backend = SessionRegistry(max_clients, client_ttl)
+        self.sessions = backend
+        self.fast_path = fast_path
+        self.scheduler = Scheduler(sleep)
+        self.shaper = Shaper(self.scheduler, max_clients, shaping_seed)
+        self.session_header = 'HTTP_' + session_header.upper().replace('-',
+                                                                       '_')
+        # with segments, rec_file is a directory, and so it is with
+        # namespaces, holding a recording per client
+        self.rec_segmented = rec_segment_size is not None or \
+            rec_segment_age is not None
+        self.rec_namespaces = rec_namespaces
+        if rec_file is None and (self.rec_segmented or rec_namespaces):
+            rec_file = tempfile.mkdtemp()
+        elif rec_file is None:
             fd, rec_file = tempfile.mkstemp()
             os.close(fd)
 
         self.rec_file = rec_file
+        self.rec_format = rec_format
+        self.rec_compress = rec_compress
+        self.matcher = matcher = matcher or Matcher()
+        # the namespaces share a writer thread
+        self._shared = None
+        if rec_namespaces:
+            self._shared = SharedWriter(rec_flush_interval, rec_batch_size,
+                                        rec_max_pending, rec_max_open)
+        self._store_factory = partial(
+            ReplayStore, format=rec_format, matcher=matcher,
+            sequence=replay_sequence, wrap=replay_wrap,
+            inline_max=replay_inline_max, metrics=self.metrics,
+            max_clients=max_clients, client_ttl=client_ttl)
+        if self.rec_segmented:
+            self._writer_factory = partial(
+                SegmentedWriter, flush_interval=rec_flush_interval,
+                batch_size=rec_batch_size, fsync=rec_fsync,
+                segment_size=rec_segment_size, segment_age=rec_segment_age,
+                keep_segments=rec_keep_segments, keep_bytes=rec_keep_bytes,
+                signature=matcher.signature(), max_pending=rec_max_pending,
+                shared=self._shared)
+        else:
+            self._writer_factory = partial(
+                RecordWriter, flush_interval=rec_flush_interval,
+                batch_size=rec_batch_size, fsync=rec_fsync,
+                max_pending=rec_max_pending, shared=self._shared)
+
+        self._recordings = OrderedDict()
+        self._recordings_lock = threading.Lock()
+        self._max_recordings = max_namespaces
+        if rec_namespaces:
+            self.store = self.writer = None
+        else:
+            self.store = self._store_factory(rec_file)
+            self.writer = self._writer_factory(rec_file)
         self.secret = secret
         self.requires_secret = requires_secret
+        if warm:
+            self.warm()
 
     def _auth(self, request):
         if not self.requires_secret:
@@ -101,7 +182,11 @@ class ClientTesterMiddleware(object):
         if provided != self.secret:
             raise exc.HTTPUnauthorized()
 
-    def _get_client_ip(self, environ):
+    def _get_client(self, environ):
+        session = environ.get(self.session_header)
+        if session:
+            return session
+
         if 'HTTP_X_FORWARDED_FOR' in environ:
             return environ['HTTP_X_FORWARDED_FOR'].split(',')[0].strip()
 
@@ -121,29 +206,93 @@ class ClientTesterMiddleware(object):
 
         return resp
 
-    def _apply_filters(self, resp, filters):
+    def _apply_filters(self, resp, filters, delay=0, outcome=None,
+                       client=None):
         status = resp.status
         intst = int(status.split()[0])
+        spec = 0
         if intst in filters:
-            time.sleep(filters[intst])
+            spec = filters[intst]
         elif '*' in filters:
-            time.sleep(filters['*'])
-
-        # XXX maybe we will have filters that change the resp
+            spec = filters['*']
+
+        if isinstance(spec, dict):
+            # a shaping filter
+            if 'delay' in spec:
+                self.metrics.observe('delay', outcome, spec['delay'] + delay)
+            return self.shaper.shape(resp, spec, client, delay)
+
+        delay += spec
+        if delay > 0:
+            self.metrics.observe('delay', outcome, delay)
+        return self.scheduler.delay(resp, delay)
+
+    def _call_app(self, request, outcome):
+        start = default_timer()
+        resp = request.get_response(self.app)
+        self.metrics.observe('app', outcome, default_timer() - start)
         return resp
 
+    def __call__(self, environ, start_response):
+        if self.fast_path and \
+                not environ.get('PATH_INFO', '').startswith(self.custom_paths):
+            client = self._get_client(environ)
+            session = self.sessions.get(client)
+            lookup = None
+            if session is not None:
+                start = default_timer()
+                lookup = self._lookup(session, client,
+                                      environ.get('REQUEST_METHOD'),
+                                      environ.get('PATH_INFO', ''))
+            if lookup is None:
+                # nothing to do for this client, the app is called
+                # as if the middleware was not there
+                metrics = self.metrics
+                if not metrics.enabled:
+                    return self.app(environ, start_response)
+
+                start = default_timer()
+                result = self.app(environ, start_response)
+                elapsed = default_timer() - start
+                metrics.observe('app', PASSTHROUGH, elapsed)
+                metrics.observe('request', PASSTHROUGH, elapsed)
+                metrics.count(client, PASSTHROUGH)
+                return result
+
+            mock = lookup[0]
+            if mock is not None and not isinstance(mock, Mock):
+                mock = Mock(mock)
+            if mock is None or mock.passthrough:
+                # _handle does not look for it again
+                environ['_lookup'] = lookup
+                return self._handle(environ, start_response)
+
+            # served without building a request or a response
+            resp = self._finish(mock, lookup[1], mock.delay, MOCK_HIT,
+                                client, start, default_timer() - start)
+            return resp(environ, start_response)
+
+        return self._handle(environ, start_response)
+
+    def _lookup(self, session, client, method, path):
+        """Pops the mock of a request, and reads the filters and recording
+        state of its session, all as left by the same control change.
+        Returns None when the session is idle."""
+        with self.sessions.client_lock(client):
+            if session.idle:
+                return None
+            return (session.mocks.pop(method, path), session.filters,
+                    session.rec_state, session.rec_rules)
+
     @wsgify
-    def __call__(self, request):
+    def _handle(self, request):
         if request.path_info in self.custom_paths:
             self._auth(request)
 
         environ = request.environ
         path = request.path_info
 
-        environ['_ip'] = ip = self._get_client_ip(environ)
-        environ['_replays'] = replays = self.replays[ip]
-        environ['_filters'] = filters = self.filters[ip]
-        environ['_is_recording'] = rec = self.is_recording[ip]
+        environ['_ip'] = ip = self._get_client(environ)
 
         # routing
         if path.startswith(self.mock_path):
@@ -152,51 +301,85 @@ class ClientTesterMiddleware(object):
             return self._filter(request)
         elif path.startswith(self.rec_path):
             return self._rec_state(request)
+        elif path.startswith(self.batch_path):
+            return self._batch(request)
+        elif path.startswith(self.metrics_path):
+            return self._metrics(request)
+
+        metrics = self.metrics
+        start = default_timer()
+        # already looked up by __call__ ?
+        lookup = environ.pop('_lookup', None)
+        if lookup is None:
+            session = self.sessions.get(ip)
+            if session is not None:
+                lookup = self._lookup(session, ip, request.method, path)
+            if lookup is None:
+                # nothing was set up by this client
+                resp = self._call_app(request, PASSTHROUGH)
+                metrics.count(ip, PASSTHROUGH)
+                metrics.observe('request', PASSTHROUGH,
+                                default_timer() - start)
+                return resp
 
         # classical call, do we have something to replay ?
-        if len(replays) > 0:
+        replay, filters, rec, rules = lookup
+        mock_time = default_timer() - start
+        if replay is not None:
             # yes
-            replay = replays.pop()
-            status = _int2status(replay.get('status', 0))
-            body = replay.get('body', u'').encode('utf8')
-            headers = replay.get('headers')
-            delay = replay.get('delay', 0)
-            passthrough = replay.get('passthrough', False)
-
-            # repeat it, always
-            if replay.get('repeat') == -1:
-                replays.insert(0, replay)
-
-            # build the response
-            if not passthrough:
-                resp = request.response
-            else:
-                resp = request.get_response(self.app)
-            if status:
-                resp.status = status
-            if body:
-                resp.body = body
-            if headers:
-                resp.headers.update(dict(headers))
+            outcome = MOCK_HIT
+            if not isinstance(replay, Mock):
+                # backends may return the stored spec
+                replay = Mock(replay)
+            delay = replay.delay
+
+            # the compiled mock serves itself
+            resp = replay
+            if replay.passthrough:
+                resp = self._call_app(request, outcome)
+                if replay.get('status'):
+                    resp.status = replay.status
+                if replay.body:
+                    if hasattr(resp.app_iter, 'close'):
+                        # the app's body is replaced, without being read
+                        resp.app_iter.close()
+                    resp.body = replay.body
+                if replay.headers:
+                    resp.headers.update(dict(replay.headers))
 
-            # apply filters
-            resp = self._apply_filters(resp, filters)
-
-            # extra delay
-            time.sleep(delay)
-
-            return resp
         else:
             # no, regular app
             # do we record or play or just call the app ?
+            delay = 0
             if rec in (DISABLED, RECORD):
-                resp = request.get_response(self.app)
-                if rec == RECORD:
-                    self._record(request, resp)
+                outcome = rec == RECORD and RECORDED or PASSTHROUGH
+                key = None
+                if rules is not None:
+                    if rules.keyed:
+                        key = self.matcher.digest(
+                            self.matcher.fingerprint(request))
+                    if not rules.accepts_request(request.method, path, key):
+                        outcome = PASSTHROUGH
+                resp = self._call_app(request, outcome)
+                if outcome == RECORDED and (
+                        rules is None or
+                        rules.accepts_response(resp.status_int, key)):
+                    self._record(request, resp, rules, key)
             else:  # REPLAY:
-                resp = self._replay(request)
-
-            return self._apply_filters(resp, filters)
+                resp, outcome = self._replay(request)
+
+        return self._finish(resp, filters, delay, outcome, ip, start,
+                            mock_time)
+
+    def _finish(self, resp, filters, delay, outcome, client, start,
+                mock_time):
+        # apply filters, plus the extra delay of a mock
+        resp = self._apply_filters(resp, filters, delay, outcome, client)
+        metrics = self.metrics
+        metrics.count(client, outcome)
+        metrics.observe('mock', outcome, mock_time)
+        metrics.observe('request', outcome, default_timer() - start)
+        return resp
 
     def _checkmeth(self, method, allowed=None):
         if allowed is None:
@@ -206,6 +389,84 @@ class ClientTesterMiddleware(object):
             raise exc.HTTPMethodNotAllowed(
                               allow=','.join(allowed))
 
+    def _json_body(self, request):
+        try:
+            return json.loads(request.body)
+        except ValueError:
+            raise exc.HTTPBadRequest()
+
+    def _recording(self, client):
+        """Returns the store and writer of the namespace of client."""
+        if not self.rec_namespaces:
+            return self.store, self.writer
+
+        recordings = self._recordings
+        with self._recordings_lock:
+            recording = recordings.pop(client, None)
+            if recording is None:
+                name = 'client-' + quote(str(client), safe='')
+                path = os.path.join(self.rec_file, name)
+                recording = self._store_factory(path), \
+                    self._writer_factory(path)
+                if len(recordings) >= self._max_recordings:
+                    # the least recently used is flushed, and loaded
+                    # again if needed
+                    recordings.popitem(last=False)[1][1].close()
+            recordings[client] = recording
+        return recording
+
+    def _rec_rules(self, spec):
+        if spec is None:
+            return None
+        try:
+            return RecordRules(spec)
+        except (ValueError, TypeError):
+            raise exc.HTTPBadRequest()
+
+    def _check_state(self, st, keep=False):
+        # None keeps the current state, where allowed
+        if st is None and keep:
+            return
+        if st not in (DISABLED, RECORD, REPLAY):
+            raise exc.HTTPBadRequest()
+
+    def _set_rec_state(self, ip, session, st, rules=_KEEP):
+        """Returns the writer to flush once the session is released, so
+        what was recorded so far is visible, or None."""
+        flush = None
+        if st is not None:
+            store, writer = self._recording(ip)
+            if st != RECORD:
+                flush = writer
+            if st == REPLAY:
+                store.rewind(ip)
+            session.rec_state = st
+
+        if rules is not _KEEP:
+            session.rec_rules = rules
+        return flush
+
+    def _parse_filters(self, new):
+        if not isinstance(new, dict):
+            raise exc.HTTPBadRequest()
+
+        filters = {}
+        for status, delay in new.items():
+            if status != '*':
+                try:
+                    status = int(status)
+                except ValueError:
+                    raise exc.HTTPBadRequest()
+            if isinstance(delay, dict):
+                if not check_shape(delay):
+                    raise exc.HTTPBadRequest()
+            elif not isinstance(delay, (int, long, float)) or \
+                    isinstance(delay, bool) or delay < 0:
+                # a plain delay, in seconds
+                raise exc.HTTPBadRequest()
+            filters[status] = delay
+        return filters
+
     def _rec_state(self, request):
         ip = request.environ['_ip']
         method = request.method
@@ -213,97 +474,224 @@ class ClientTesterMiddleware(object):
 
         if method == 'POST':
             # define the toggle
-            try:
-                st = json.loads(request.body)
-            except ValueError:
-                raise exc.HTTPBadRequest()
-
-            self.is_recording[ip] = st
+            # either the state, or {"state": state, "rules": rules}
+            st, rules = self._json_body(request), _KEEP
+            if isinstance(st, dict):
+                if 'rules' in st:
+                    rules = self._rec_rules(st['rules'])
+                st = st.get('state')
+                self._check_state(st, keep=True)
+            else:
+                self._check_state(st)
+            with self.sessions.atomic(ip):
+                writer = self._set_rec_state(
+                    ip, self.sessions.get_or_create(ip), st, rules)
+            # flushing in the atomic block would stall the other clients
+            # of the lock
+            if writer is not None:
+                writer.flush()
             return self._resp(request)
 
-        status = json.dumps(self.is_recording[ip])
+        session = self.sessions.get(ip)
+        status = json.dumps(session.rec_state if session else DISABLED)
         return self._resp(request, body=status)
 
     def _mock(self, request):
         # what's the method ?
         method = request.method
-        self._checkmeth(method)
-        replays = request.environ['_replays']
+        self._checkmeth(method, ('POST', 'DELETE', 'GET'))
+        ip = request.environ['_ip']
+
+        if method == 'GET':
+            session = self.sessions.get(ip)
+            replays = session.mocks if session else MockQueue()
+            return self._resp(request, body=json.dumps(replays.status()))
 
         if method == 'DELETE':
             # wipe out
-            replays[:] = []
+            with self.sessions.atomic(ip):
+                self.sessions.get_or_create(ip).mocks.clear()
             return self._resp(request)
 
         # that's something to add to the pile
+        mock = self._compile_mock(self._json_body(request))
+        with self.sessions.atomic(ip):
+            replays = self.sessions.get_or_create(ip).mocks
+            replays.push(mock, mock.repeat)
+        return self._resp(request)
+
+    def _compile_mock(self, spec):
+        if not isinstance(spec, dict):
+            raise exc.HTTPBadRequest()
         try:
-            resp = json.loads(request.body)
-        except ValueError:
+            return Mock(spec)
+        except (TypeError, ValueError):
             raise exc.HTTPBadRequest()
 
-        repeat = resp.get('repeat', 1)
-        if repeat == -1:
-            # will repeat indefinitely
-            replays.insert(0, resp)
-        else:
-            for i in range(repeat):
-                replays.insert(0, resp)
-
-        return self._resp(request)
-
     def _filter(self, request):
         # what's the method ?
         method = request.method
         self._checkmeth(method)
-        filters = request.environ['_filters']
+        ip = request.environ['_ip']
 
         if method == 'DELETE':
             # wipe out
-            filters.clear()
-            return self._resp(request)
+            filters = {}
+        else:
+            # that's something to set
+            filters = self._parse_filters(self._json_body(request))
 
-        # that's something to set
-        try:
-            new = json.loads(request.body)
-        except ValueError:
-            raise exc.HTTPBadRequest()
+        with self.sessions.atomic(ip):
+            self.sessions.get_or_create(ip).filters = filters
+        return self._resp(request)
 
-        filters.clear()
+    def _batch_action(self, ip, op):
+        """Checks a batch operation, and returns a function applying it
+        to a session. The function returns a writer to flush once the
+        session is released, or None."""
+        if not isinstance(op, dict):
+            raise exc.HTTPBadRequest()
 
-        for status, delay in new.items():
-            if status != '*':
-                status = int(status)
-            filters[status] = delay
+        op = dict(op)
+        name = op.pop('op', None)
+        if name == 'mock':
+            mock = self._compile_mock(op)
+            return lambda session: session.mocks.push(mock, mock.repeat)
+        elif name == 'del_mocks':
+            return lambda session: session.mocks.clear()
+        elif name == 'filter':
+            filters = self._parse_filters(op.get('filters'))
+            return lambda session: setattr(session, 'filters', filters)
+        elif name == 'del_filters':
+            return lambda session: setattr(session, 'filters', {})
+        elif name == 'record':
+            st, rules = op.get('state'), _KEEP
+            self._check_state(st, keep=True)
+            if 'rules' in op:
+                rules = self._rec_rules(op['rules'])
+            return lambda session: self._set_rec_state(ip, session, st,
+                                                       rules)
+
+        raise exc.HTTPBadRequest()
+
+    def _batch(self, request):
+        self._checkmeth(request.method, ('POST',))
+        ops = self._json_body(request)
+        if not isinstance(ops, list):
+            raise exc.HTTPBadRequest()
 
+        # everything is checked before anything is applied
+        ip = request.environ['_ip']
+        actions = [self._batch_action(ip, op) for op in ops]
+
+        flushes = set()
+        with self.sessions.atomic(ip):
+            session = self.sessions.get_or_create(ip)
+            for action in actions:
+                writer = action(session)
+                if writer is not None:
+                    flushes.add(writer)
+
+        for writer in flushes:
+            writer.flush()
         return self._resp(request)
 
     def _replay(self, request):
+        start = default_timer()
         ip = request.environ['_ip']
-        resp = get_record(self.rec_file, request)
+        resp = self._recording(ip)[0].get(request, ip)
+        outcome = resp is None and REPLAY_MISS or REPLAY_HIT
+        self.metrics.observe('replay', outcome, default_timer() - start)
         if resp is None:
             # failed to find a matching record
             # by-passing
-            return request.get_response(self.app)
-
-        return resp
+            return self._call_app(request, outcome), outcome
 
-    def _record(self, request, resp):
-        data = []
+        return resp, outcome
 
-        data.append('--Request:\n')
-        data.append(str(request))
-        if not request.content_length:
-            data.append('\n')
+    def _metrics(self, request):
+        self._checkmeth(request.method, ('GET', 'DELETE'))
+        if request.method == 'DELETE':
+            self.metrics.reset()
+            return self._resp(request)
 
-        data.append('\n--Response:\n')
-        data.append(str(resp))
-        if not resp.body:
-            data.append('\n')
-        data.append('\n')
+        format = request.GET.get('format')
+        if format is None and \
+                'text/plain' in request.headers.get('Accept', ''):
+            format = 'prometheus'
+        if format == 'prometheus':
+            resp = self._resp(request, body=self.metrics.as_prometheus())
+            resp.content_type = 'text/plain'
+            resp.content_type_params = {'version': '0.0.4'}
+            return resp
 
-        self.lock.acquire()
-        try:
-            with open(self.rec_file, 'a+') as f:
-                f.write(''.join(data))
-        finally:
-            self.lock.release()
+        return self._resp(request, body=json.dumps(self.metrics.as_dict()))
+
+    def _record(self, request, resp, rules=None, key=None):
+        # the body is copied to the recording as it is served
+        req_head = request.as_bytes(skip_body=True)
+        req_body = request.body
+        if request.content_length is None:
+            # from_file would read the rest of a text recording
+            req_head += '\r\nContent-Length: 0'
+        status, headerlist = resp.status, list(resp.headerlist)
+        writer = self._recording(request.environ['_ip'])[1]
+        if self.rec_segmented and key is None:
+            # for the index of the segment
+            key = self.matcher.digest(self.matcher.fingerprint(request))
+
+        limit = hasher = None
+        if rules is not None and rules.max_body is not None:
+            limit = rules.max_body
+            if rules.oversize == HASH:
+                hasher = md5()
+
+        def record(body, length):
+            stored = length
+            if limit is not None and length > limit:
+                if hasher is not None:
+                    # only the digest of the body is kept
+                    body.close()
+                    body, stored = StringIO(), 0
+                    headerlist.append(('X-Webtestplus-Body-MD5',
+                                       hasher.hexdigest()))
+                    headerlist.append(('X-Webtestplus-Length', str(length)))
+                else:
+                    stored = limit
+                    headerlist.append(('X-Webtestplus-Truncated',
+                                       str(length)))
+            resp_head = response_head(status, headerlist, stored)
+            if self.rec_format == BINARY:
+                pieces = binary_pieces(req_head, req_body, resp_head, body,
+                                       stored, self.rec_compress)
+            else:
+                pieces = text_pieces(req_head, req_body, resp_head, body)
+            writer.write(pieces, key)
+
+        length = resp.content_length
+        resp.app_iter = TeeIter(resp.app_iter, record, limit=limit,
+                                hasher=hasher)
+        resp.content_length = length
+
+    def _all_recordings(self):
+        with self._recordings_lock:
+            recordings = self._recordings.values()
+        if not self.rec_namespaces:
+            recordings.append((self.store, self.writer))
+        return recordings
+
+    def warm(self, processes=None):
+        """Loads the recordings with a pool of processes, so the first
+        replays don't pay for parsing.
+
+        With namespaces, the recordings of the clients seen so far are
+        loaded."""
+        for store, writer in self._all_recordings():
+            store.warm(processes)
+
+    def close(self):
+        """Writes the pending records and stops the writer threads."""
+        for store, writer in self._all_recordings():
+            writer.close()
+        if self._shared is not None:
+            self._shared.close()
@@ -1,6 +1,41 @@
+import os
+import mmap
+import stat
+import struct
+import sys
+import zlib
+import threading
+import time
+from collections import OrderedDict
+from hashlib import md5
+from tempfile import SpooledTemporaryFile
+from timeit import default_timer
+from urllib import unquote
 from warnings import warn
+from webob.headers import ResponseHeaders
 from webtest import TestRequest, TestResponse
 
+from webtestplus.matching import Matcher
+from webtestplus.metrics import NULL_METRICS
+from webtestplus.writer import INDEX_SUFFIX
+
+
+TEXT = 'text'
+BINARY = 'binary'
+
+# binary records: magic, flags, stored payload length, then the
+# lengths of the request head, request body, response head and
+# response body. The payload is those four parts, zlib-compressed
+# as a whole when the COMPRESSED flag is set.
+_HEADER = struct.Struct('>4sBIIIII')
+_MAGIC = 'WTPR'
+_COMPRESSED = 1
+
+# bodies above this size are not kept in memory by ReplayStore, but
+# read from the recording when served
+INLINE_MAX = 64 * 1024
+_CHUNK = 64 * 1024
+
 
 def _matching(asked, stored):
     if asked.method != stored.method:
@@ -15,55 +50,578 @@ def _matching(asked, stored):
     return True
 
 
-def _read_recs(filename, req_class=TestRequest,
-               resp_class=TestResponse):
-    recs = []
+def _iter_recs(f, req_class=TestRequest, resp_class=TestResponse,
+               read_request=None, read_response=None):
+    if read_request is None:
+        read_request = req_class.from_file
+    if read_response is None:
+        read_response = resp_class.from_file
 
-    with open(filename, 'rb') as f:
-        while 1:
+    while 1:
+        line = f.readline()
+        if not line:
+            break
+
+        line = line.strip()
+        if not line:
+            # Because we add a newline at the end of the request, a
+            # blank line is likely here:
             line = f.readline()
             if not line:
                 break
-
             line = line.strip()
-            if not line:
-                # Because we add a newline at the end of the request, a
-                # blank line is likely here:
-                line = f.readline()
-                if not line:
-                    break
-                line = line.strip()
-            if not line.startswith('--Request:'):
-                warn('Invalid line (--Request: expected) at byte %s in %s'
-                     % (f.tell(), f))
+        if not line.startswith('--Request:'):
+            warn('Invalid line (--Request: expected) at byte %s in %s'
+                 % (f.tell(), f))
 
-            # reading the request
-            req = req_class.from_file(f)
+        # reading the request
+        req = read_request(f)
 
+        line = f.readline()
+        if not line.strip():
             line = f.readline()
-            if not line.strip():
-                line = f.readline()
 
+        if not line:
+            yield req
 
+        line = line.strip()
+        if not line:
+            line = f.readline()
             if not line:
-                recs.append(req)
-
+                break
             line = line.strip()
-            if not line:
-                line = f.readline()
-                if not line:
+        if not line.startswith('--Response:'):
+            warn('Invalid line (--Response: expected) at byte %s in %s'
+                 % (f.tell(), f))
+
+        resp = read_response(f)
+        resp.request = req
+        req.response = resp
+        yield req
+
+
+def _read_recs(filename, req_class=TestRequest,
+               resp_class=TestResponse):
+    with open(filename, 'rb') as f:
+        return list(_iter_recs(f, req_class, resp_class))
+
+
+def _iter_text_parts(filename):
+    # as the store reads them: a request may have no Content-Length
+    for req, end in _iter_text(filename, inline_max=sys.maxint):
+        resp = getattr(req, 'response', None)
+        if resp is not None:
+            yield req.head, req.body, resp.head, resp.body
+
+
+def _split_head(head):
+    lines = head.split('\r\n')
+    headerlist = []
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headerlist.append((name, value.strip()))
+    return lines[0], headerlist
+
+
+class RecordedRequest(object):
+    """The parts of a recorded request used for matching.
+
+    The headers are only parsed when asked for.
+    """
+    __slots__ = ('method', 'path_info', 'query_string', 'head', 'body',
+                 'response')
+
+    def __init__(self, method, path_info, query_string, head, body,
+                 response=None):
+        self.method = method
+        self.path_info = path_info
+        self.query_string = query_string
+        self.head = head
+        self.body = body
+        self.response = response
+
+    @property
+    def headerlist(self):
+        return _split_head(self.head)[1]
+
+    @property
+    def headers(self):
+        return ResponseHeaders(self.headerlist)
+
+
+class FileSlice(object):
+    """Iterates over length bytes of a file, starting at offset.
+
+    Has no fileno(), so a wsgi.file_wrapper cannot send past the slice.
+    """
+    def __init__(self, filename, offset, length, chunk=_CHUNK):
+        self.file = open(filename, 'rb')
+        self.file.seek(offset)
+        self.remaining = length
+        self.chunk = chunk
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.chunk)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+# content codings of the replayed bodies, preferred first
+CODINGS = ('gzip', 'deflate')
+
+# headers kept in a 304 response
+_NOT_MODIFIED = ('cache-control', 'content-location', 'date', 'etag',
+                 'expires', 'vary')
+
+
+def _header(headerlist, name):
+    for header, value in headerlist:
+        if header.lower() == name:
+            return value
+    return None
+
+
+def _encode(body, coding):
+    if coding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(body) + compressor.flush()
+    return zlib.compress(body)
+
+
+def accepted_codings(header):
+    """Returns the CODINGS accepted by an Accept-Encoding header, in the
+    order of preference."""
+    weights = {}
+    for item in header.split(','):
+        name, _, params = item.partition(';')
+        weight = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0
+        weights[name.strip().lower()] = weight
+    default = weights.get('*', 0)
+    codings = [(weights.get(coding, default), -index, coding)
+               for index, coding in enumerate(CODINGS)]
+    return [coding for weight, _, coding in sorted(codings, reverse=True)
+            if weight > 0]
+
+
+def _coded_etag(etag, coding):
+    # a strong validator differs between the codings of a body
+    if etag.endswith('"'):
+        return '%s-%s"' % (etag[:-1], coding)
+    return '%s-%s' % (etag, coding)
+
+
+def _none_match(header, etags):
+    for etag in header.split(','):
+        etag = etag.strip()
+        if etag.startswith('W/'):
+            etag = etag[2:]
+        if etag == '*' or etag in etags:
+            return True
+    return False
+
+
+class RecordedResponse(object):
+    """A recorded response, built into a resp_class on demand.
+
+    The body is either kept in memory, or read from length bytes at
+    offset in filename when served.
+
+    Successful responses kept in memory are also served conditionally
+    and compressed, from the variants computed by encode().
+    """
+    __slots__ = ('head', 'body', 'filename', 'offset', 'length', 'request',
+                 'variants')
+
+    def __init__(self, head, body, filename=None, offset=0, length=0,
+                 request=None):
+        self.head = head
+        self.body = body
+        self.filename = filename
+        self.offset = offset
+        self.length = length
+        self.request = request
+        self.variants = None
+
+    def encode(self):
+        """Computes the ETag and the compressed bodies of the response,
+        once. Returns a mapping of coding to (etag, headerlist, body),
+        where None is the identity."""
+        variants = self.variants
+        if variants is not None or self.body is None:
+            return variants
+
+        headerlist = _split_head(self.head)[1]
+        etag = _header(headerlist, 'etag')
+        bodies = {None: (etag or '"%s"' % md5(self.body).hexdigest(),
+                         self.body)}
+        if _header(headerlist, 'content-encoding') is None:
+            for coding in CODINGS:
+                body = _encode(self.body, coding)
+                if len(body) < len(self.body):
+                    bodies[coding] = _coded_etag(bodies[None][0], coding), \
+                        body
+
+        headers = [(name, value) for name, value in headerlist
+                   if name.lower() not in ('content-length', 'etag')]
+        if len(bodies) > 1:
+            vary = _header(headers, 'vary')
+            if vary is None:
+                headers.append(('Vary', 'Accept-Encoding'))
+            elif 'accept-encoding' not in vary.lower():
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'vary']
+                headers.append(('Vary', vary + ', Accept-Encoding'))
+
+        variants = {}
+        for coding, (tag, body) in bodies.items():
+            variant = headers + [('ETag', tag)]
+            if coding is not None:
+                variant.append(('Content-Encoding', coding))
+            variant.append(('Content-Length', str(len(body))))
+            variants[coding] = tag, variant, body
+        self.variants = variants
+        return variants
+
+    def _negotiate(self, status, environ):
+        variants = self.encode()
+        coding = None
+        accept = environ.get('HTTP_ACCEPT_ENCODING')
+        if accept and len(variants) > 1:
+            for accepted in accepted_codings(accept):
+                if accepted in variants:
+                    coding = accepted
+                    break
+        etag, headerlist, body = variants[coding]
+
+        match = environ.get('HTTP_IF_NONE_MATCH')
+        if match is not None and \
+                _none_match(match, [tag for tag, _, _ in variants.values()]):
+            headerlist = [(name, value) for name, value in headerlist
+                          if name.lower() in _NOT_MODIFIED]
+            return '304 Not Modified', headerlist, ''
+
+        # the response may change its headers
+        return status, list(headerlist), body
+
+    def build(self, resp_class=TestResponse, file_wrapper=None,
+              environ=None):
+        status = self.head.partition('\r\n')[0]
+        if status.startswith('HTTP/'):
+            status = status.split(None, 1)[1]
+
+        if self.body is not None and environ is not None and \
+                status.startswith('200'):
+            status, headerlist, body = self._negotiate(status, environ)
+            return resp_class(status=status, headerlist=headerlist,
+                              app_iter=[body])
+
+        headerlist = _split_head(self.head)[1]
+        if self.body is not None:
+            app_iter = [self.body]
+        else:
+            app_iter = FileSlice(self.filename, self.offset, self.length)
+            if file_wrapper is not None:
+                app_iter = file_wrapper(app_iter, _CHUNK)
+
+        return resp_class(status=status, headerlist=headerlist,
+                          app_iter=app_iter)
+
+
+def _content_length(headerlist):
+    for name, value in headerlist:
+        if name.lower() == 'content-length':
+            return int(value)
+    return 0
+
+
+def _read_head(f):
+    lines = []
+    while True:
+        line = f.readline().strip()
+        if not line:
+            break
+        lines.append(line)
+    return '\r\n'.join(lines)
+
+
+def _text_readers(filename, size, inline_max=INLINE_MAX):
+    """Returns the read_request and read_response functions used by
+    ReplayStore with _iter_recs.
+
+    Unlike from_file, a request without a Content-Length has no body,
+    and large response bodies are skipped.
+    """
+    def read_request(f):
+        head = _read_head(f)
+        method, url, _ = head.split('\r\n', 1)[0].split(' ', 2)
+        path, _, query_string = url.partition('?')
+        body = f.read(_content_length(_split_head(head)[1]))
+        return RecordedRequest(method, unquote(path), query_string, head,
+                               body)
+
+    def read_response(f):
+        head = _read_head(f)
+        length = _content_length(_split_head(head)[1])
+        offset = f.tell()
+        if offset + length > size:
+            # still being written
+            raise EOFError()
+
+        if length <= inline_max:
+            return RecordedResponse(head, f.read(length))
+
+        f.seek(length, os.SEEK_CUR)
+        return RecordedResponse(head, None, filename, offset, length)
+
+    return read_request, read_response
+
+
+def _iter_text(filename, offset=0, req_class=None, inline_max=INLINE_MAX):
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        read_request, read_response = _text_readers(filename, size,
+                                                    inline_max)
+        recs = _iter_recs(f, read_request=read_request,
+                          read_response=read_response)
+        try:
+            for rec in recs:
+                yield rec, f.tell()
+        except EOFError:
+            return
+
+
+def _iter_binary_parts(filename, offset=0):
+    """Yields the raw parts of each binary record, the offset of its
+    response body in the file (None when compressed), and its end offset.
+
+    The parts of uncompressed records are buffers over a read-only mmap:
+    they are only valid until the next iteration.
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= offset:
+            return
+
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while offset + _HEADER.size <= size:
+                (magic, flags, stored, req_head, req_body, resp_head,
+                 resp_body) = _HEADER.unpack_from(data, offset)
+                if magic != _MAGIC:
+                    warn('Invalid record at byte %s in %s' % (offset, f))
                     break
-                line = line.strip()
-            if not line.startswith('--Response:'):
-                warn('Invalid line (--Response: expected) at byte %s in %s'
-                     % (f.tell(), f))
 
-            resp = resp_class.from_file(f)
-            resp.request = req
-            req.response = resp
-            recs.append(req)
+                start = offset + _HEADER.size
+                end = start + stored
+                if end > size:
+                    # still being written
+                    break
+
+                if flags & _COMPRESSED:
+                    payload = zlib.decompress(data[start:end])
+                    start = 0
+                    body_offset = None
+                else:
+                    payload = data
+                    body_offset = end - resp_body
+
+                parts = []
+                for length in req_head, req_body, resp_head, resp_body:
+                    parts.append(buffer(payload, start, length))
+                    start += length
+
+                yield parts, body_offset, end
+                offset = end
+        finally:
+            data.close()
+
+
+def _iter_binary(filename, offset=0, req_class=None,
+                 inline_max=INLINE_MAX):
+    for (req_head, req_body, resp_head, resp_body), body_offset, end in \
+            _iter_binary_parts(filename, offset):
+        head = str(req_head)
+        method, url, _ = head.split('\r\n', 1)[0].split(' ', 2)
+        path, _, query_string = url.partition('?')
+        if '%' in path:
+            path = unquote(path)
+        req = RecordedRequest(method, path, query_string, head,
+                              str(req_body))
+
+        if body_offset is None or len(resp_body) <= inline_max:
+            resp = RecordedResponse(str(resp_head), str(resp_body))
+        else:
+            resp = RecordedResponse(str(resp_head), None, filename,
+                                    body_offset, len(resp_body))
+        resp.request = req
+        req.response = resp
+        yield req, end
+
+
+_READERS = {TEXT: _iter_text, BINARY: _iter_binary}
+
+
+class IndexedResponse(object):
+    """A response known by the offset of its record, read when served."""
+    __slots__ = ('filename', 'format', 'offset', 'inline_max')
+
+    def __init__(self, filename, format, offset, inline_max=INLINE_MAX):
+        self.filename = filename
+        self.format = format
+        self.offset = offset
+        self.inline_max = inline_max
+
+    def build(self, resp_class=TestResponse, file_wrapper=None,
+              environ=None):
+        # read each time, the body is served as recorded
+        reader = _READERS[self.format](self.filename, self.offset, None,
+                                       self.inline_max)
+        try:
+            rec, end = next(reader)
+        finally:
+            reader.close()
+        return rec.response.build(resp_class, file_wrapper)
+
+
+def _parts(request, response):
+    req_head = request.as_bytes(skip_body=True)
+    headers = ['%s: %s' % header for header in response.headerlist]
+    resp_head = '\r\n'.join([response.status] + headers)
+    return req_head, request.body, resp_head, response.body
+
+
+def _text_record(req_head, req_body, resp_head, resp_body):
+    return '--Request:\n%s\r\n\r\n%s\n--Response:\n%s\r\n\r\n%s\n' % (
+        req_head, req_body, resp_head, resp_body)
+
+
+def _binary_record(req_head, req_body, resp_head, resp_body,
+                   compress=False):
+    parts = req_head, req_body, resp_head, resp_body
+    payload = ''.join(parts)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload)
+        flags |= _COMPRESSED
+    lengths = [len(part) for part in parts]
+    return _HEADER.pack(_MAGIC, flags, len(payload), *lengths) + payload
+
+
+def response_head(status, headerlist, length):
+    """Returns the head of a response whose body is length bytes."""
+    lines = [status]
+    for name, value in headerlist:
+        if name.lower() not in ('content-length', 'transfer-encoding'):
+            lines.append('%s: %s' % (name, value))
+    lines.append('Content-Length: %d' % length)
+    return '\r\n'.join(lines)
+
+
+def text_pieces(req_head, req_body, resp_head, body):
+    """Returns the pieces of a text record, where body is a file."""
+    if req_body:
+        req = '%s\r\n\r\n%s' % (req_head, req_body)
+    else:
+        req = req_head + '\n'
+    return ['--Request:\n%s\n--Response:\n%s\r\n\r\n' % (req, resp_head),
+            body, '\n']
+
+
+def binary_pieces(req_head, req_body, resp_head, body, length,
+                  compress=False):
+    """Returns the pieces of a binary record, where body is a file of
+    length bytes. When compressing, body is consumed and closed.
+    """
+    lengths = len(req_head), len(req_body), len(resp_head), length
+    if not compress:
+        header = _HEADER.pack(_MAGIC, 0, sum(lengths), *lengths)
+        return [header, req_head, req_body, resp_head, body]
+
+    compressor = zlib.compressobj()
+    payload = SpooledTemporaryFile(max_size=_CHUNK)
+    for part in req_head, req_body, resp_head:
+        payload.write(compressor.compress(part))
+    try:
+        while True:
+            data = body.read(_CHUNK)
+            if not data:
+                break
+            payload.write(compressor.compress(data))
+    finally:
+        body.close()
+    payload.write(compressor.flush())
+    stored = payload.tell()
+    payload.seek(0)
+    header = _HEADER.pack(_MAGIC, _COMPRESSED, stored, *lengths)
+    return [header, payload]
+
+
+def dump_text(request, response):
+    """Serializes an exchange in the text format."""
+    data = []
+
+    data.append('--Request:\n')
+    data.append(str(request))
+    if not request.content_length:
+        data.append('\n')
+
+    data.append('\n--Response:\n')
+    data.append(str(response))
+    if not response.body:
+        data.append('\n')
+    data.append('\n')
+    return ''.join(data)
+
+
+def dump_binary(request, response, compress=False):
+    """Serializes an exchange as a length-prefixed binary record."""
+    return _binary_record(*_parts(request, response), compress=compress)
+
+
+def convert(source, target, source_format=TEXT, target_format=BINARY,
+            compress=False):
+    """Appends the records of source to target, in target_format.
+
+    compress only applies to a binary target.
+    """
+    if source_format == BINARY:
+        records = (map(str, parts)
+                   for parts, body_offset, end in _iter_binary_parts(source))
+    else:
+        records = _iter_text_parts(source)
+
+    count = 0
+    with open(target, 'ab') as f:
+        for parts in records:
+            if target_format == BINARY:
+                f.write(_binary_record(*parts, compress=compress))
+            else:
+                f.write(_text_record(*parts))
+            count += 1
+    return count
 
-    return recs
+
+def _stamp(st):
+    return st.st_ino, st.st_mtime, st.st_size
 
 
 def get_record(filename, request, ):
@@ -72,3 +630,289 @@ def get_record(filename, request, ):
     for rec in recs:
         if _matching(request, rec):
             return rec.response
+
+
+class ReplayStore(object):
+    """Indexed view of recordings, in the TEXT or BINARY format.
+
+    filename is a recording file, or a directory of recordings loaded in
+    name order. In a directory, added and removed files are noticed
+    through the mtime of the directory.
+
+    The files are parsed once and the responses are kept in a dict keyed
+    on the fingerprint computed by matcher, a Matcher by default, so a
+    lookup is a single dict access.
+
+    The files are stat'ed on each lookup: when one grew, only its new
+    records are parsed. When one shrank, was replaced or removed, all are
+    loaded again.
+
+    A file with a sidecar index written by SegmentedWriter is not parsed:
+    only its index is read, and each record is read at its offset when
+    served. Indexes are not used by fuzzy matchers, or when written with
+    other matching options.
+
+    Bodies larger than inline_max bytes are not loaded: they are streamed
+    from the file when served.
+
+    When a request was recorded several times, its responses are served in
+    the recorded order, with a cursor per client. Once the last one is
+    reached, it is served again, or the sequence starts over if wrap is
+    True. With sequence=False, the first response is always served.
+    Cursors are kept for the max_clients most recently seen clients, and
+    for client_ttl seconds, as sessions are.
+    """
+    def __init__(self, filename, format=TEXT, req_class=TestRequest,
+                 resp_class=TestResponse, inline_max=INLINE_MAX,
+                 matcher=None, sequence=True, wrap=False, metrics=None,
+                 max_clients=10000, client_ttl=3600):
+        self.filename = filename
+        self.metrics = metrics or NULL_METRICS
+        self.matcher = matcher or Matcher()
+        self.format = format
+        self.req_class = req_class
+        self.resp_class = resp_class
+        self.inline_max = inline_max
+        self.sequence = sequence
+        self.wrap = wrap
+        self.lock = threading.Lock()
+        self.max_clients = max_clients
+        self.client_ttl = client_ttl
+        self._cursors = OrderedDict()
+        self._cursors_lock = threading.Lock()
+        self._listing = None, []
+        self._reset()
+
+    def _reset(self):
+        self._index = {}
+        self._routes = {}
+        # offset and stamp of each loaded file
+        self._files = {}
+        # offset in the sidecar index of each indexed file
+        self._sidecars = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def _load(self, path):
+        offset = self._files.get(path, (0, None))[0]
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+
+        if self._load_index(path, st):
+            return
+
+        reader = _READERS[self.format]
+        for rec, end in reader(path, offset, self.req_class,
+                               self.inline_max):
+            if getattr(rec, 'response', None) is not None:
+                self._add(rec)
+            offset = end
+        self._files[path] = offset, _stamp(st)
+
+    def _load_index(self, path, st):
+        """Loads the records of path from its sidecar index. Returns False
+        when there is no usable index."""
+        if self.matcher.fuzzy:
+            return False
+
+        offset = self._sidecars.get(path)
+        try:
+            f = open(path + INDEX_SUFFIX, 'rb')
+        except IOError:
+            return False
+
+        end = self._files.get(path, (0, None))[0]
+        with f:
+            if offset is None:
+                signature = f.readline()
+                if signature.rstrip('\n') != self.matcher.signature():
+                    return False
+                offset = len(signature)
+            else:
+                f.seek(offset)
+
+            for line in f:
+                if not line.endswith('\n'):
+                    # still being written
+                    break
+                key, start, length = line.split()
+                start = int(start)
+                if start + int(length) > st.st_size:
+                    break
+                resp = IndexedResponse(path, self.format, start,
+                                       self.inline_max)
+                self._index.setdefault(key, []).append(resp)
+                end = max(end, start + int(length))
+                offset += len(line)
+
+        self._sidecars[path] = offset
+        self._files[path] = end, _stamp(st)
+        return True
+
+    def _add(self, rec):
+        matcher = self.matcher
+        features = matcher.features(rec)
+        self.add(matcher.route(rec), features,
+                 matcher.fingerprint(rec, features), rec.response)
+
+    def add(self, route, features, key, response):
+        """Indexes a recorded response."""
+        responses = self._index.get(key)
+        if responses is None:
+            self._index[key] = [response]
+            if self.matcher.fuzzy:
+                self._routes.setdefault(route, []).append((features, key))
+        else:
+            responses.append(response)
+
+    def _lookup(self, request):
+        """Returns the fingerprint of the record matching request, or
+        None."""
+        matcher = self.matcher
+        features = matcher.features(request)
+        key = matcher.fingerprint(request, features)
+        if key in self._index or not matcher.fuzzy:
+            return key
+
+        candidates = self._routes.get(matcher.route(request))
+        if not candidates:
+            return None
+
+        # ties go to the first recorded
+        best = max(candidates,
+                   key=lambda candidate: matcher.score(features,
+                                                       candidate[0]))
+        return best[1]
+
+    def _next(self, key, responses, client):
+        now = time.time()
+        clients = self._cursors
+        with self._cursors_lock:
+            ttl = self.client_ttl
+            seen, cursors = clients.pop(client, (now, {}))
+            if ttl is not None and now - seen > ttl:
+                cursors = {}
+            # the most recently seen come last
+            clients[client] = now, cursors
+            while len(clients) > self.max_clients or (
+                    ttl is not None and
+                    now - next(clients.itervalues())[0] > ttl):
+                clients.popitem(last=False)
+            index = cursors.get(key, 0)
+            if index + 1 < len(responses):
+                cursors[key] = index + 1
+            elif self.wrap:
+                cursors[key] = 0
+        return responses[index]
+
+    def rewind(self, client=None):
+        """Replays the sequences of client from their start."""
+        with self._cursors_lock:
+            self._cursors.pop(client, None)
+
+    def paths(self):
+        """Returns the recording files, in loading order."""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return []
+
+        if not stat.S_ISDIR(st.st_mode):
+            return [self.filename]
+
+        mtime, paths = self._listing
+        if mtime != st.st_mtime:
+            paths = [os.path.join(self.filename, name)
+                     for name in sorted(os.listdir(self.filename))]
+            paths = [path for path in paths if os.path.isfile(path)
+                     and not path.endswith(INDEX_SUFFIX)]
+            self._listing = st.st_mtime, paths
+        return paths
+
+    def _changed(self, paths):
+        """Returns the files to load, or None when all have to be."""
+        files = self._files
+        if len(files) > len(paths) or not set(files).issubset(paths):
+            # removed files
+            return None
+
+        changed = []
+        for path in paths:
+            if path not in files:
+                changed.append(path)
+                continue
+            # any segment may still be appended to, until it rotates
+            try:
+                stamp = _stamp(os.stat(path))
+            except OSError:
+                return None
+
+            offset, old = files[path]
+            if stamp != old:
+                if (old[0] != stamp[0] or stamp[2] < offset
+                        or stamp[2] == old[2]):
+                    # truncated or rewritten
+                    return None
+                changed.append(path)
+        return changed
+
+    def refresh(self):
+        """Picks up the changes made to the files since the last call."""
+        paths = self.paths()
+        changed = self._changed(paths)
+        if changed == []:
+            return
+
+        with self.lock:
+            start = default_timer()
+            changed = self._changed(paths)
+            if changed is None:
+                self._reset()
+                changed = paths
+            for path in changed:
+                self._load(path)
+            self.metrics.observe('load', None, default_timer() - start)
+
+    def warm(self, processes=None):
+        """Loads the recordings with a pool of processes, one per CPU by
+        default."""
+        from webtestplus.loader import load
+
+        with self.lock:
+            self._reset()
+            # indexed files are not parsed
+            paths = [path for path in self.paths()
+                     if not self._load_index(path, os.stat(path))]
+            for path, entries, offset, stamp in load(
+                    paths, self.format, self.matcher, self.inline_max,
+                    processes):
+                for entry in entries:
+                    self.add(*entry)
+                self._files[path] = offset, stamp
+
+    def get(self, request, client=None):
+        """Returns the recorded response matching request, or None."""
+        self.refresh()
+        key = self._lookup(request)
+        responses = self._index.get(key)
+        if responses is None and self._sidecars and key is not None:
+            key = self.matcher.digest(key)
+            responses = self._index.get(key)
+        if responses is None:
+            return None
+
+        if len(responses) == 1 or not self.sequence:
+            resp = responses[0]
+        else:
+            resp = self._next(key, responses, client)
+
+        environ = request.environ
+        try:
+            return resp.build(self.resp_class,
+                              environ.get('wsgi.file_wrapper'), environ)
+        except (IOError, StopIteration):
+            # a segment deleted since it was indexed
+            return None
@@ -0,0 +1,143 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Recording rules
+"""
+import threading
+import zlib
+
+from webtestplus.mocks import match_path
+
+__all__ = ['RecordRules']
+
+TRUNCATE = 'truncate'
+HASH = 'hash'
+
+
+def _pattern(spec):
+    if not isinstance(spec, dict) or \
+            set(spec) - set(['method', 'path']):
+        raise ValueError(spec)
+    method = spec.get('method')
+    if method is not None:
+        method = method.upper()
+    return method, spec.get('path')
+
+
+def _status(spec):
+    # 404, or a class such as "5xx"
+    if isinstance(spec, int):
+        return spec
+    if isinstance(spec, basestring) and len(spec) == 3 and \
+            spec[0] in '12345' and spec[1:].lower() == 'xx':
+        return int(spec[0])
+    raise ValueError(spec)
+
+
+class RecordRules(object):
+    """Decides which exchanges a client records, from a dict of:
+
+    - include: list of {"method", "path"} patterns, only the matching
+      requests are recorded. Paths are patterns as for mocks.
+    - exclude: list of patterns, the matching requests are not recorded.
+    - status: list of statuses or classes ("2xx"), only the responses
+      with one of them are recorded.
+    - max_body: bytes of response body kept at most. Beyond, the body is
+      truncated, or with oversize "hash" replaced by its MD5 digest.
+    - sample: records 1 request in sample, chosen on the fingerprint so
+      the same requests are always recorded.
+    - dedup: when true, a fingerprint is only recorded once.
+
+    Requests are checked before the application is called, responses
+    before their body is copied.
+    """
+    def __init__(self, spec):
+        if not isinstance(spec, dict) or set(spec) - set([
+                'include', 'exclude', 'status', 'max_body', 'oversize',
+                'sample', 'dedup']):
+            raise ValueError(spec)
+        self.spec = spec
+        self.include = [_pattern(item) for item in spec.get('include', [])]
+        self.exclude = [_pattern(item) for item in spec.get('exclude', [])]
+        self.status = set(_status(item) for item in spec.get('status', []))
+        self.max_body = spec.get('max_body')
+        if self.max_body is not None and \
+                (not isinstance(self.max_body, int) or self.max_body < 0):
+            raise ValueError(self.max_body)
+        self.oversize = spec.get('oversize', TRUNCATE)
+        if self.oversize not in (TRUNCATE, HASH):
+            raise ValueError(self.oversize)
+        self.sample = spec.get('sample', 1)
+        if not isinstance(self.sample, int) or self.sample < 1:
+            raise ValueError(self.sample)
+        self.dedup = bool(spec.get('dedup'))
+        self._seen = set()
+        self._lock = threading.Lock()
+
+    @property
+    def keyed(self):
+        """True when the fingerprint of requests is needed."""
+        return self.sample > 1 or self.dedup
+
+    def _matches(self, patterns, method, path):
+        for pattern_method, pattern_path in patterns:
+            if pattern_method in (None, '*', method) and \
+                    match_path(pattern_path, path):
+                return True
+        return False
+
+    def accepts_request(self, method, path, key=None):
+        """Tells if a request may be recorded. key is the digest of its
+        fingerprint, needed when keyed is true."""
+        if self.include and not self._matches(self.include, method, path):
+            return False
+        if self._matches(self.exclude, method, path):
+            return False
+        if self.sample > 1 and \
+                (zlib.crc32(key) & 0xffffffff) % self.sample:
+            return False
+        return not (self.dedup and key in self._seen)
+
+    def accepts_response(self, status, key=None):
+        """Tells if a response to an accepted request is recorded."""
+        if self.status and status not in self.status and \
+                status // 100 not in self.status:
+            return False
+        if self.dedup:
+            with self._lock:
+                if key in self._seen:
+                    return False
+                self._seen.add(key)
+        return True
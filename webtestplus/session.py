@@ -0,0 +1,492 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Per-client state
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from webtestplus.mocks import MockQueue, match_path
+from webtestplus.rules import RecordRules
+
+__all__ = ['ClientSession', 'SessionRegistry', 'SQLiteRegistry']
+
+
+DISABLED = 'disabled'
+RECORD = 'recording'
+REPLAY = 'playing'
+
+
+class ClientSession(object):
+    """What a client has set up: mocks, filters and recording state.
+
+    filters is replaced as a whole, never changed in place.
+    """
+    __slots__ = ('mocks', 'filters', 'rec_state', 'rec_rules', 'last_seen')
+
+    def __init__(self):
+        self.mocks = MockQueue()
+        self.filters = {}
+        self.rec_state = DISABLED
+        self.rec_rules = None
+        self.last_seen = time.time()
+
+    @property
+    def idle(self):
+        """True when the session does not change the requests."""
+        return (not self.mocks and not self.filters
+                and self.rec_state == DISABLED)
+
+
+class SessionRegistry(object):
+    """Sessions by client, in a LRU bounded to max_clients entries.
+
+    A session not used for ttl seconds expires. Looking up a client
+    that has no session allocates nothing.
+
+    lock only guards the LRU. The control changes of a client are
+    serialized by one of stripes locks, picked by hashing the client, so
+    clients that don't share a stripe never wait on each other.
+    """
+    def __init__(self, max_clients=10000, ttl=3600, stripes=64):
+        self.max_clients = max_clients
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self._stripes = [threading.RLock() for i in range(stripes)]
+        self._sessions = OrderedDict()
+
+    def client_lock(self, client):
+        return self._stripes[hash(client) % len(self._stripes)]
+
+    @contextmanager
+    def atomic(self, client=None):
+        """Groups control changes of client, applied in one go."""
+        with self.client_lock(client):
+            yield
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _expired(self, session, now):
+        return self.ttl is not None and now - session.last_seen > self.ttl
+
+    def get(self, client):
+        """Returns the session of client, or None."""
+        session = self._sessions.get(client)
+        if session is None:
+            return None
+
+        now = time.time()
+        if self._expired(session, now):
+            with self.lock:
+                self._sessions.pop(client, None)
+            return None
+
+        if now - session.last_seen > 1:
+            # moving to the end is not free, so the order is only
+            # refreshed once per second and per client
+            with self.lock:
+                if self._sessions.pop(client, None) is not None:
+                    self._sessions[client] = session
+        session.last_seen = now
+        return session
+
+    def get_or_create(self, client):
+        session = self.get(client)
+        if session is not None:
+            return session
+
+        with self.lock:
+            session = self._sessions.get(client)
+            if session is None:
+                session = self._sessions[client] = ClientSession()
+                self._evict(session.last_seen)
+            return session
+
+    def _evict(self, now):
+        sessions = self._sessions
+        while sessions:
+            client, oldest = next(iter(sessions.iteritems()))
+            if len(sessions) <= self.max_clients and \
+                    not self._expired(oldest, now):
+                break
+            del sessions[client]
+
+    def clear(self):
+        with self.lock:
+            self._sessions.clear()
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    client TEXT PRIMARY KEY,
+    rec_state TEXT NOT NULL,
+    rec_rules TEXT,
+    filters TEXT NOT NULL,
+    last_seen REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS mocks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    client TEXT NOT NULL,
+    method TEXT,
+    path TEXT,
+    spec TEXT NOT NULL,
+    remaining INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS mocks_client ON mocks (client, id);
+"""
+
+_GET = """
+SELECT rec_state, rec_rules, filters, last_seen,
+       EXISTS (SELECT 1 FROM mocks WHERE mocks.client = clients.client)
+FROM clients WHERE client = ?"""
+
+
+class _NoLock(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_LOCK = _NoLock()
+
+
+class SQLiteMockQueue(object):
+    """MockQueue API over the mocks table.
+
+    The method is matched by SQLite, the path pattern of the remaining
+    mocks in Python. Popping from the queue of a session read without
+    mocks does not query the database.
+    """
+    __slots__ = ('registry', 'client', 'session')
+
+    def __init__(self, registry, client, session=None):
+        self.registry = registry
+        self.client = client
+        self.session = session
+
+    def __len__(self):
+        conn = self.registry.connection()
+        return conn.execute('SELECT COUNT(*) FROM mocks WHERE client = ?',
+                            (self.client,)).fetchone()[0]
+
+    def push(self, spec, repeat=1):
+        if repeat == -1 or repeat > 0:
+            method = spec.get('method')
+            if method is not None:
+                method = None if method == '*' else method.upper()
+            with self.registry.transaction() as conn:
+                conn.execute('INSERT INTO mocks '
+                             '(client, method, path, spec, remaining) '
+                             'VALUES (?, ?, ?, ?, ?)',
+                             (self.client, method, spec.get('path'),
+                              json.dumps(spec), repeat))
+            if self.session is not None:
+                self.session._has_mocks = True
+
+    def pop(self, method=None, path=None):
+        """Returns the next mock to serve for a request, or None. This is
+        atomic across processes."""
+        if self.session is not None and not self.session._has_mocks:
+            return None
+        with self.registry.transaction() as conn:
+            rows = conn.execute('SELECT id, path, spec, remaining FROM mocks '
+                                'WHERE client = ? AND '
+                                '(method IS NULL OR method = ?) '
+                                'ORDER BY id', (self.client, method))
+            for id, pattern, spec, remaining in rows:
+                if path is None or match_path(pattern, path):
+                    break
+            else:
+                return None
+            rows.close()
+
+            if remaining == -1:
+                conn.execute('UPDATE mocks SET id = '
+                             '(SELECT MAX(id) + 1 FROM mocks) WHERE id = ?',
+                             (id,))
+            elif remaining > 1:
+                conn.execute('UPDATE mocks SET remaining = ? WHERE id = ?',
+                             (remaining - 1, id))
+            else:
+                conn.execute('DELETE FROM mocks WHERE id = ?', (id,))
+        return json.loads(spec)
+
+    def clear(self):
+        with self.registry.transaction() as conn:
+            conn.execute('DELETE FROM mocks WHERE client = ?',
+                         (self.client,))
+
+    def status(self):
+        conn = self.registry.connection()
+        rows = conn.execute('SELECT spec, remaining FROM mocks '
+                            'WHERE client = ? ORDER BY id',
+                            (self.client,)).fetchall()
+        mocks = []
+        for spec, remaining in rows:
+            spec = json.loads(spec)
+            mock = {'status': spec.get('status'), 'remaining': remaining}
+            for option in ('method', 'path'):
+                if spec.get(option) is not None:
+                    mock[option] = spec[option]
+            mocks.append(mock)
+        return {'length': len(mocks), 'mocks': mocks}
+
+
+class SQLiteSession(object):
+    """A session read from a SQLiteRegistry. Setting an attribute
+    writes it to the database."""
+    __slots__ = ('registry', 'client', '_rec_state', '_rec_rules',
+                 '_filters', '_has_mocks')
+
+    def __init__(self, registry, client, rec_state, rec_rules, filters,
+                 has_mocks):
+        self.registry = registry
+        self.client = client
+        self._rec_state = rec_state
+        self._rec_rules = rec_rules
+        self._filters = filters
+        self._has_mocks = has_mocks
+
+    @property
+    def mocks(self):
+        return SQLiteMockQueue(self.registry, self.client, self)
+
+    def _get_filters(self):
+        return self._filters
+
+    def _set_filters(self, filters):
+        self.registry.update(self.client, 'filters',
+                             json.dumps(filters.items()))
+        self._filters = filters
+
+    filters = property(_get_filters, _set_filters)
+
+    def _get_rec_state(self):
+        return self._rec_state
+
+    def _set_rec_state(self, rec_state):
+        self.registry.update(self.client, 'rec_state', rec_state)
+        self._rec_state = rec_state
+
+    rec_state = property(_get_rec_state, _set_rec_state)
+
+    def _get_rec_rules(self):
+        return self._rec_rules
+
+    def _set_rec_rules(self, rules):
+        data = rules and json.dumps(rules.spec)
+        self.registry.update(self.client, 'rec_rules', data)
+        self._rec_rules = rules
+
+    rec_rules = property(_get_rec_rules, _set_rec_rules)
+
+    @property
+    def idle(self):
+        return (not self._has_mocks and not self._filters
+                and self._rec_state == DISABLED)
+
+
+class SQLiteRegistry(object):
+    """Sessions stored in a SQLite database in WAL mode.
+
+    All the processes using the same path share the sessions, so a
+    control call reaches every worker of a multi-process server. Looking
+    up a client is a single indexed SELECT.
+    """
+    def __init__(self, path, max_clients=10000, ttl=3600, timeout=5.):
+        self.path = path
+        self.max_clients = max_clients
+        self.ttl = ttl
+        self.timeout = timeout
+        self._local = threading.local()
+        self._filters = {}
+        self._rules = {}
+        conn = self.connection()
+        conn.executescript(_SCHEMA)
+        columns = [row[1] for row in
+                   conn.execute('PRAGMA table_info(clients)')]
+        if 'rec_rules' not in columns:
+            # databases created by older versions
+            conn.execute('ALTER TABLE clients ADD COLUMN rec_rules TEXT')
+
+    def connection(self):
+        """Returns the connection of the current thread and process."""
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.timeout,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            local.conn, local.pid = conn, os.getpid()
+        return local.conn
+
+    @contextmanager
+    def transaction(self):
+        """Runs the block in a write transaction. Nested blocks are part
+        of the outermost transaction."""
+        conn = self.connection()
+        local = self._local
+        if getattr(local, 'depth', 0):
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+
+        conn.execute('BEGIN IMMEDIATE')
+        local.depth = 1
+        try:
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+        finally:
+            local.depth = 0
+
+    def client_lock(self, client):
+        # a session is read in one query, and changed in one transaction
+        return _NO_LOCK
+
+    @contextmanager
+    def atomic(self, client=None):
+        """Groups control changes, applied in one transaction."""
+        with self.transaction():
+            yield
+
+    def __len__(self):
+        conn = self.connection()
+        return conn.execute('SELECT COUNT(*) FROM clients').fetchone()[0]
+
+    def _load_filters(self, data):
+        # the same few filter sets are read over and over
+        filters = self._filters.get(data)
+        if filters is None:
+            filters = dict((key, value) for key, value in json.loads(data))
+            if len(self._filters) < 1000:
+                self._filters[data] = filters
+        return filters
+
+    def _load_rules(self, client, data):
+        if data is None:
+            return None
+        # compiled rules keep state, so they are not shared by clients
+        key = client, data
+        rules = self._rules.get(key)
+        if rules is None:
+            rules = RecordRules(json.loads(data))
+            if len(self._rules) >= self.max_clients:
+                self._rules.clear()
+            self._rules[key] = rules
+        return rules
+
+    def _expired(self, last_seen, now):
+        return self.ttl is not None and now - last_seen > self.ttl
+
+    def _delete(self, conn, client):
+        conn.execute('DELETE FROM clients WHERE client = ?', (client,))
+        conn.execute('DELETE FROM mocks WHERE client = ?', (client,))
+
+    def get(self, client):
+        """Returns the session of client, or None."""
+        client = client or ''
+        conn = self.connection()
+        row = conn.execute(_GET, (client,)).fetchone()
+        if row is None:
+            return None
+
+        rec_state, rec_rules, filters, last_seen, has_mocks = row
+        now = time.time()
+        if self._expired(last_seen, now):
+            with self.transaction() as conn:
+                self._delete(conn, client)
+            return None
+
+        if now - last_seen > 1:
+            conn.execute('UPDATE clients SET last_seen = ? WHERE client = ?',
+                         (now, client))
+
+        return SQLiteSession(self, client, rec_state,
+                             self._load_rules(client, rec_rules),
+                             self._load_filters(filters), has_mocks)
+
+    def get_or_create(self, client):
+        session = self.get(client)
+        if session is not None:
+            return session
+
+        client = client or ''
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('INSERT OR IGNORE INTO clients '
+                         '(client, rec_state, filters, last_seen) '
+                         'VALUES (?, ?, ?, ?)', (client, DISABLED, '[]', now))
+            self._evict(conn, now)
+        return self.get(client)
+
+    def _evict(self, conn, now):
+        if self.ttl is not None:
+            expired = conn.execute('SELECT client FROM clients '
+                                   'WHERE last_seen < ?',
+                                   (now - self.ttl,)).fetchall()
+            for client, in expired:
+                self._delete(conn, client)
+
+        count = conn.execute('SELECT COUNT(*) FROM clients').fetchone()[0]
+        if count > self.max_clients:
+            oldest = conn.execute('SELECT client FROM clients '
+                                  'ORDER BY last_seen LIMIT ?',
+                                  (count - self.max_clients,)).fetchall()
+            for client, in oldest:
+                self._delete(conn, client)
+
+    def update(self, client, column, value):
+        # column is one of ours, never user input
+        with self.transaction() as conn:
+            conn.execute('UPDATE clients SET %s = ? WHERE client = ?'
+                         % column, (value, client))
+
+    def clear(self):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM clients')
+            conn.execute('DELETE FROM mocks')
@@ -0,0 +1,202 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Traffic shaping filters
+"""
+import random
+import threading
+from collections import OrderedDict
+
+from webob import Response
+
+__all__ = ['TokenBucket', 'ShapedIter', 'Shaper', 'check_shape']
+
+DISTRIBUTIONS = ('uniform', 'normal', 'exponential')
+_NUMBERS = ('delay', 'jitter', 'rate', 'burst', 'chunk', 'error_rate')
+
+
+def check_shape(spec):
+    """Returns True if spec is a valid shaping filter."""
+    if not isinstance(spec, dict):
+        return False
+    for name, value in spec.items():
+        if name in _NUMBERS:
+            if not isinstance(value, (int, long, float)) or value < 0:
+                return False
+        elif name == 'distribution':
+            if value not in DISTRIBUTIONS:
+                return False
+        elif name == 'error_status':
+            if not isinstance(value, int) or not 100 <= value < 600:
+                return False
+        else:
+            return False
+    return spec.get('error_rate', 0) <= 1
+
+
+class TokenBucket(object):
+    """Allows rate bytes per second, with bursts of up to burst bytes.
+
+    reserve() never blocks: it takes the tokens, going into debt when
+    there are not enough, and returns when the bytes may be sent. Streams
+    sharing a bucket share its rate.
+    """
+    def __init__(self, rate, burst, clock):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self, size):
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            if self.tokens >= 0:
+                return now
+            return now - self.tokens / self.rate
+
+
+class ShapedIter(object):
+    """Wraps an app_iter, holding its first chunk until deadline, then
+    sending it in chunks of chunk bytes at the pace of bucket.
+
+    Waits go through the scheduler, like delays.
+    """
+    def __init__(self, app_iter, deadline, scheduler, bucket=None,
+                 chunk=4096):
+        self.app_iter = app_iter
+        self.deadline = deadline
+        self.scheduler = scheduler
+        self.bucket = bucket
+        self.chunk = chunk
+
+    def __iter__(self):
+        self.scheduler.wait_until(self.deadline)
+        bucket, chunk, wait_until = (self.bucket, self.chunk,
+                                     self.scheduler.wait_until)
+        for data in self.app_iter:
+            if bucket is None:
+                yield data
+                continue
+            for start in xrange(0, len(data), chunk):
+                piece = data[start:start + chunk]
+                wait_until(bucket.reserve(len(piece)))
+                yield piece
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+class Shaper(object):
+    """Applies shaping filters to responses.
+
+    A filter is a dict of:
+
+    - delay: seconds before the first byte.
+    - jitter: extra seconds before the first byte, drawn from a uniform
+      distribution between 0 and jitter, or with distribution 'normal'
+      the absolute value of a normal one of standard deviation jitter,
+      or with 'exponential' an exponential one of mean jitter.
+    - rate: body bytes per second, shared by all the responses of a
+      client, with bursts of up to burst bytes (rate by default), sent in
+      chunks of chunk bytes (4096 by default).
+    - error_rate: probability of replacing the response with an
+      error_status one (503 by default).
+    """
+    def __init__(self, scheduler, max_clients=10000, seed=None):
+        self.scheduler = scheduler
+        self.max_clients = max_clients
+        self.random = random.Random(seed)
+        self._buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def bucket(self, client, rate, burst):
+        bucket = self._buckets.get(client)
+        if bucket is not None and bucket.rate == rate and \
+                bucket.burst == burst:
+            return bucket
+
+        with self.lock:
+            bucket = TokenBucket(rate, burst, self.scheduler.clock)
+            self._buckets.pop(client, None)
+            self._buckets[client] = bucket
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return bucket
+
+    def jitter(self, spec):
+        jitter = spec.get('jitter', 0)
+        if not jitter:
+            return 0
+        distribution = spec.get('distribution', 'uniform')
+        if distribution == 'normal':
+            return abs(self.random.gauss(0, jitter))
+        elif distribution == 'exponential':
+            return self.random.expovariate(1. / jitter)
+        return self.random.uniform(0, jitter)
+
+    def shape(self, resp, spec, client, delay=0):
+        """Returns a WSGI app serving resp shaped by spec, after delay
+        extra seconds."""
+        error_rate = spec.get('error_rate')
+        if error_rate and self.random.random() < error_rate:
+            app_iter = getattr(resp, 'app_iter', None)
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            resp = Response(status=spec.get('error_status', 503))
+
+        delay += spec.get('delay', 0) + self.jitter(spec)
+        bucket = None
+        rate = spec.get('rate')
+        if rate:
+            bucket = self.bucket(client, rate, spec.get('burst', rate))
+        if delay <= 0 and bucket is None:
+            return resp
+
+        deadline = self.scheduler.clock() + delay
+        chunk = int(spec.get('chunk', 4096)) or 4096
+        scheduler = self.scheduler
+
+        def shaped(environ, start_response):
+            app_iter = resp(environ, start_response)
+            return ShapedIter(app_iter, deadline, scheduler, bucket, chunk)
+
+        return shaped
@@ -0,0 +1,57 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Tests for webtestplus.bench
+"""
+import unittest
+
+from webtestplus.bench import run, SCENARIOS
+from webtestplus.recorder import TEXT
+
+
+class TestBench(unittest.TestCase):
+
+    def test_run(self):
+        results = run(requests=20, threads=(1, 2), sizes=(5, 50),
+                      format=TEXT)
+        # replay runs once per size
+        self.assertEqual(len(results), (len(SCENARIOS) + 1) * 2)
+        for result in results:
+            self.assertEqual(result['requests'], 20)
+            self.assertTrue(result['rps'] > 0)
+            self.assertTrue(result['p99'] >= result['p50'])
+        sizes = [result['size'] for result in results
+                 if result['scenario'] == 'replay']
+        self.assertEqual(sizes, [5, 5, 50, 50])
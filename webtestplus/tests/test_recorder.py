@@ -0,0 +1,788 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Tests for webtestplus.recorder
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+from hashlib import md5
+from tempfile import SpooledTemporaryFile
+
+from webtestplus.recorder import (ReplayStore, TEXT, BINARY, convert,
+                                  dump_binary, dump_text, FileSlice,
+                                  IndexedResponse)
+from webtestplus import ClientTesterMiddleware, TestAppPlus
+from webtestplus.loader import load, shards
+from webtestplus.matching import Matcher
+from webtestplus.rules import RecordRules
+from webtestplus.session import SQLiteRegistry
+from webtestplus.writer import RecordWriter, SharedWriter, segments, _STOP
+from webob import Response, exc
+from webtest import TestRequest
+
+
+def _write(filename, path, body, resp_body, mode='a'):
+    req = TestRequest.blank(path, method='POST', body=body)
+    resp = Response(body=resp_body, content_type='text/plain')
+    with open(filename, mode) as f:
+        f.write('--Request:\n%s\n--Response:\n%s\n' % (req, resp))
+
+
+class TestReplayStore(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        self.store = ReplayStore(self.filename)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def _get(self, path, body):
+        return self.store.get(TestRequest.blank(path, method='POST',
+                                                body=body))
+
+    def test_lookup(self):
+        _write(self.filename, '/1', 'tic', 'one')
+        _write(self.filename, '/1', 'tac', 'two')
+        _write(self.filename, '/1', 'tic', 'three')
+
+        self.assertEqual(self._get('/1', 'tic').body, 'one')
+        self.assertEqual(self._get('/1', 'tac').body, 'two')
+        self.assertEqual(self._get('/1', 'toe'), None)
+        self.assertEqual(self._get('/2', 'tic'), None)
+        self.assertEqual(len(self.store), 2)
+
+    def test_cursors(self):
+        for body in 'one', 'two', 'three':
+            _write(self.filename, '/1', 'tic', body)
+        store = ReplayStore(self.filename, max_clients=2, client_ttl=60)
+        req = TestRequest.blank('/1', method='POST', body='tic')
+
+        def get(client):
+            return store.get(req, client).body
+
+        self.assertEqual([get('a'), get('a'), get('b'), get('c')],
+                         ['one', 'two', 'one', 'one'])
+        # the least recently seen client starts over
+        self.assertEqual(list(store._cursors), ['b', 'c'])
+        self.assertEqual(get('a'), 'one')
+        self.assertEqual(get('c'), 'two')
+
+        # and so does a client not seen for client_ttl seconds
+        for client in 'a', 'c':
+            seen, cursors = store._cursors[client]
+            store._cursors[client] = seen - 61, cursors
+        self.assertEqual(get('c'), 'one')
+        self.assertEqual(list(store._cursors), ['c'])
+
+    def test_incremental_reload(self):
+        _write(self.filename, '/1', 'tic', 'one')
+        self.assertEqual(self._get('/1', 'tic').body, 'one')
+        offset = self.store._files[self.filename][0]
+
+        _write(self.filename, '/2', 'tac', 'two')
+        self.assertEqual(self._get('/2', 'tac').body, 'two')
+        self.assertTrue(self.store._files[self.filename][0] > offset)
+        self.assertEqual(len(self.store), 2)
+
+        # the file is truncated and rewritten: full reload
+        _write(self.filename, '/3', 'toe', 'three', mode='w')
+        self.assertEqual(self._get('/3', 'toe').body, 'three')
+        self.assertEqual(self._get('/1', 'tic'), None)
+        self.assertEqual(len(self.store), 1)
+
+    def test_negotiation(self):
+        body = '{"items": [%s]}' % ', '.join(['"item"'] * 100)
+        _write(self.filename, '/1', 'tic', body)
+        _write(self.filename, '/2', 'tac', 'short')
+
+        def get(path, body, **headers):
+            req = TestRequest.blank(path, method='POST', body=body,
+                                    headers=headers)
+            return self.store.get(req)
+
+        plain = get('/1', 'tic')
+        self.assertEqual(plain.body, body)
+        self.assertEqual(plain.headers['Vary'], 'Accept-Encoding')
+        etag = plain.headers['ETag']
+        self.assertEqual(etag, '"%s"' % md5(body).hexdigest())
+
+        gzipped = get('/1', 'tic', Accept_Encoding='deflate;q=0.5, gzip')
+        self.assertEqual(gzipped.content_encoding, 'gzip')
+        self.assertTrue(gzipped.content_length < len(body))
+        self.assertEqual(gzipped.decode_content(), None)
+        self.assertEqual(gzipped.body, body)
+        deflated = get('/1', 'tic', Accept_Encoding='gzip;q=0, *')
+        self.assertEqual(deflated.content_encoding, 'deflate')
+        self.assertNotEqual(deflated.headers['ETag'], etag)
+
+        # the variants are computed once
+        variants = self.store._index.values()[0][0].variants
+        self.assertTrue(variants is not None)
+        self.assertTrue(get('/1', 'tic').body is variants[None][2])
+
+        for tag in (etag, deflated.headers['ETag'], 'W/' + etag, '*'):
+            resp = get('/1', 'tic', If_None_Match=tag)
+            self.assertEqual(resp.status_int, 304)
+            self.assertEqual(resp.body, '')
+            self.assertFalse('Content-Type' in resp.headers)
+        self.assertEqual(get('/1', 'tic', If_None_Match='"x"').status_int,
+                         200)
+
+        # not worth compressing
+        short = get('/2', 'tac', Accept_Encoding='gzip')
+        self.assertEqual(short.body, 'short')
+        self.assertEqual(short.content_encoding, None)
+        self.assertFalse('Vary' in short.headers)
+
+        # a recorded ETag is kept, and told apart for each coding
+        resp = Response(body=body)
+        resp.headers['ETag'] = '"v1"'
+        with open(self.filename, 'a') as f:
+            f.write(dump_text(TestRequest.blank('/3'), resp))
+        req = TestRequest.blank('/3')
+        self.assertEqual(self.store.get(req).headers['ETag'], '"v1"')
+        req.headers['Accept-Encoding'] = 'gzip'
+        self.assertEqual(self.store.get(req).headers['ETag'], '"v1-gzip"')
+
+    def test_binary(self):
+        # bodies holding the text markers are not a problem
+        body = '\x00--Request:\n\r\n--Response:\n\xff'
+        req = TestRequest.blank('/bin?a=1', method='POST', body=body)
+        resp = Response(body=body[::-1], content_type='text/plain')
+        with open(self.filename, 'wb') as f:
+            f.write(dump_binary(req, resp))
+            f.write(dump_binary(req, Response(body='second'), compress=True))
+
+        store = ReplayStore(self.filename, BINARY)
+        found = store.get(TestRequest.blank('/bin?a=1', method='POST',
+                                            body=body))
+        self.assertEqual(found.body, body[::-1])
+        self.assertEqual(found.content_type, 'text/plain')
+        self.assertEqual(len(store), 1)
+
+    def test_convert(self):
+        _write(self.filename, '/1', 'tic', 'one')
+        # a GET has no Content-Length
+        with open(self.filename, 'a') as f:
+            f.write(dump_text(TestRequest.blank('/get'),
+                              Response(body='got')))
+        _write(self.filename, '/2', 'tac', 'two')
+
+        fd, binary = tempfile.mkstemp()
+        os.close(fd)
+        fd, text = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assertEqual(convert(self.filename, binary,
+                                     compress=True), 3)
+            self.assertEqual(convert(binary, text, BINARY, TEXT), 3)
+
+            for filename, format in ((binary, BINARY), (text, TEXT)):
+                store = ReplayStore(filename, format)
+                req = TestRequest.blank('/2', method='POST', body='tac')
+                self.assertEqual(store.get(req).body, 'two')
+                req = TestRequest.blank('/get')
+                self.assertEqual(store.get(req).body, 'got')
+                self.assertEqual(len(store), 3)
+        finally:
+            os.remove(binary)
+            os.remove(text)
+
+
+class TestLoader(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _fill(self, name, format, count):
+        dump = format == BINARY and dump_binary or dump_text
+        with open(os.path.join(self.dir, name), 'wb') as f:
+            for i in range(count):
+                req = TestRequest.blank('/%s/%d' % (name, i % 50))
+                f.write(dump(req, Response(body='%s-%d' % (name, i))))
+
+    def _check(self, format):
+        self._fill('a', format, 200)
+        self._fill('b', format, 100)
+        path = os.path.join(self.dir, 'a')
+        bounds = shards(path, format, 1024)
+        self.assertTrue(len(bounds) > 4)
+        self.assertEqual(bounds[-1][1], os.path.getsize(path))
+
+        # parallel shards give the same index as a serial load
+        loaded = load([path], format, processes=2, shard_size=1024)
+        self.assertEqual(len(loaded[0][1]), 200)
+        # the workers computed the variants served
+        for _, _, _, resp in loaded[0][1]:
+            self.assertEqual(resp.variants[None][2], resp.body)
+
+        store = ReplayStore(self.dir, format)
+        store.warm(2)
+        self.assertEqual(len(store), 100)
+        serial = ReplayStore(self.dir, format)
+        serial.refresh()
+        self.assertEqual(sorted(store._index), sorted(serial._index))
+        self.assertEqual(store._files, serial._files)
+
+        # sequences keep the recorded order
+        req = TestRequest.blank('/a/1')
+        bodies = [store.get(req).body for i in range(5)]
+        self.assertEqual(bodies, ['a-1', 'a-51', 'a-101', 'a-151', 'a-151'])
+        self.assertEqual(store.get(TestRequest.blank('/b/2')).body, 'b-2')
+
+        # nothing to parse again, until a file is added
+        store.refresh()
+        self.assertEqual(len(store), 100)
+        self._fill('c', format, 1)
+        self.assertEqual(store.get(TestRequest.blank('/c/0')).body, 'c-0')
+
+    def test_text(self):
+        self._check(TEXT)
+
+    def test_binary(self):
+        self._check(BINARY)
+
+    def test_fake_bounds(self):
+        # bodies looking like the start of a text record
+        path = os.path.join(self.dir, 'a')
+        with open(path, 'wb') as f:
+            for i in range(50):
+                body = 'x\n--Request:\nGET /fake HTTP/1.1\n%d\n' % i
+                f.write(dump_text(TestRequest.blank('/a/%d' % i),
+                                  Response(body=body * 5)))
+        serial = ReplayStore(self.dir)
+        serial.refresh()
+        self.assertEqual(len(serial), 50)
+
+        def index(shard_size):
+            loaded = load([path], processes=2, shard_size=shard_size)
+            return loaded[0][2], [(key, resp.body)
+                                  for _, _, key, resp in loaded[0][1]]
+
+        expected = index(os.path.getsize(path))
+        self.assertEqual(len(expected[1]), 50)
+        for shard_size in (100, 333, 1024, 4096):
+            self.assertEqual(index(shard_size), expected)
+
+
+class TestMatcher(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+        reqs = [TestRequest.blank('/q?b=2&a=1'),
+                TestRequest.blank('/j', method='PUT',
+                                  body='{"a": 1, "b": [1, 2]}'),
+                TestRequest.blank('/h', headers={'X-Tenant': 'one'}),
+                TestRequest.blank('/h', headers={'X-Tenant': 'two'})]
+        with open(self.filename, 'w') as f:
+            for index, req in enumerate(reqs):
+                f.write(dump_text(req, Response(body=str(index))))
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def _get(self, store, *args, **kw):
+        resp = store.get(TestRequest.blank(*args, **kw))
+        return resp and resp.body
+
+    def test_canonical(self):
+        store = ReplayStore(self.filename)
+        self.assertEqual(self._get(store, '/q?a=1&b=2'), '0')
+        self.assertEqual(self._get(store, '/q?a=1'), None)
+        self.assertEqual(self._get(store, '/j', method='PUT',
+                                   body='{"b":[1,2],"a":1}'), '1')
+        self.assertEqual(self._get(store, '/j', method='PUT',
+                                   body='{"b":[2,1],"a":1}'), None)
+
+        # headers only count when asked for
+        self.assertEqual(self._get(store, '/h',
+                                   headers={'X-Tenant': 'two'}), '2')
+        store = ReplayStore(self.filename,
+                            matcher=Matcher(headers=['x-tenant'],
+                                            ignore_params=['b']))
+        self.assertEqual(self._get(store, '/h',
+                                   headers={'X-Tenant': 'two'}), '3')
+        self.assertEqual(self._get(store, '/q?a=1&b=3'), '0')
+
+    def test_fuzzy(self):
+        store = ReplayStore(self.filename, matcher=Matcher(fuzzy=True))
+        self.assertEqual(self._get(store, '/q?a=1&c=3'), '0')
+        self.assertEqual(self._get(store, '/j', method='PUT', body='{}'),
+                         '1')
+        self.assertEqual(self._get(store, '/nope'), None)
+
+
+class TestStreaming(unittest.TestCase):
+
+    def _app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        for i in range(100):
+            yield '%04d' % i * 256
+
+    def _check(self, format):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     rec_format=format)
+        testapp = TestAppPlus(app)
+        try:
+            testapp.start_recording()
+            body = testapp.get('/big').body
+            self.assertEqual(len(body), 102400)
+            testapp.start_replaying()
+
+            # the body is served from the recording file
+            store = ReplayStore(app.rec_file, format, inline_max=1024)
+            wrapped = []
+
+            def file_wrapper(filelike, block_size):
+                wrapped.append(filelike)
+                return iter(lambda: filelike.read(block_size), '')
+
+            req = TestRequest.blank('/big', environ={
+                'wsgi.file_wrapper': file_wrapper})
+            resp = store.get(req)
+            self.assertTrue(isinstance(wrapped[0], FileSlice))
+            self.assertEqual(resp.content_length, 102400)
+            self.assertEqual(''.join(resp.app_iter), body)
+            wrapped[0].close()
+
+            # and through the middleware
+            app.app = None
+            self.assertEqual(testapp.get('/big').body, body)
+        finally:
+            app.close()
+            os.remove(app.rec_file)
+
+    def test_text(self):
+        self._check(TEXT)
+
+    def test_binary(self):
+        self._check(BINARY)
+
+
+class TestSegments(unittest.TestCase):
+
+    def setUp(self):
+        self.served = 0
+
+    def _app(self, environ, start_response):
+        self.served += 1
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['%s %d' % (environ['PATH_INFO'], self.served) + 'x' * 100]
+
+    def _check(self, format):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     rec_format=format,
+                                     rec_segment_size=1024,
+                                     rec_keep_segments=3)
+        testapp = TestAppPlus(app)
+        try:
+            testapp.start_recording()
+            bodies = [testapp.get('/%d' % i).body for i in range(40)]
+            testapp.get('/39')
+            testapp.start_replaying()
+
+            names = os.listdir(app.rec_file)
+            self.assertEqual(len(segments(app.rec_file)), 3)
+            self.assertEqual(len(names), 6)
+
+            # the last requests are replayed, in order
+            self.assertEqual(testapp.get('/39').body, bodies[39])
+            self.assertEqual(testapp.get('/39').body[:6], '/39 41')
+            self.assertEqual(testapp.get('/38').body, bodies[38])
+            # the oldest segments were deleted
+            self.assertNotEqual(testapp.get('/0').body, bodies[0])
+
+            # nothing was parsed
+            store = app.store
+            self.assertEqual(len(store._sidecars), 3)
+            for responses in store._index.values():
+                for resp in responses:
+                    self.assertTrue(isinstance(resp, IndexedResponse))
+
+            # without a usable index, segments are parsed
+            store = ReplayStore(app.rec_file, format,
+                                matcher=Matcher(query=False))
+            req = TestRequest.blank('/38')
+            self.assertEqual(store.get(req).body, bodies[38])
+            self.assertEqual(store._sidecars, {})
+        finally:
+            app.close()
+            shutil.rmtree(app.rec_file)
+
+    def test_text(self):
+        self._check(TEXT)
+
+    def test_binary(self):
+        self._check(BINARY)
+
+    def test_growing_segment(self):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     rec_segment_size=1024)
+        testapp = TestAppPlus(app)
+        try:
+            testapp.start_recording()
+            bodies = {1: testapp.get('/1').body}
+            testapp.start_replaying()
+            self.assertEqual(testapp.get('/1').body, bodies[1])
+
+            # what follows goes first to the segment read above
+            testapp.start_recording()
+            for index in range(2, 12):
+                bodies[index] = testapp.get('/%d' % index).body
+            testapp.start_replaying()
+            self.assertTrue(len(segments(app.rec_file)) > 1)
+            served = self.served
+            for index in range(1, 12):
+                self.assertEqual(testapp.get('/%d' % index).body,
+                                 bodies[index])
+            self.assertEqual(self.served, served)
+        finally:
+            app.close()
+            shutil.rmtree(app.rec_file)
+
+
+class TestNamespaces(unittest.TestCase):
+
+    def _app(self, environ, start_response):
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [environ.get('HTTP_X_TESTING_SESSION') or
+                environ['REMOTE_ADDR']]
+
+    def test_sessions(self):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     rec_namespaces=True)
+        one = TestAppPlus(app, session='one')
+        two = TestAppPlus(app, session='two/..')
+        other = TestAppPlus(app, extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+        try:
+            for testapp in one, two, other:
+                testapp.start_recording()
+                testapp.get('/same')
+            # the sessions share an IP, not their state
+            self.assertEqual(one.rec_status(), 'recording')
+            self.assertEqual(TestAppPlus(app).rec_status(), 'disabled')
+
+            for testapp in one, two, other:
+                testapp.start_replaying()
+            app.app = None
+            self.assertEqual(one.get('/same').body, 'one')
+            self.assertEqual(two.get('/same').body, 'two/..')
+            self.assertEqual(other.get('/same').body, '10.0.0.1')
+
+            self.assertEqual(sorted(os.listdir(app.rec_file)),
+                             ['client-10.0.0.1', 'client-one',
+                              'client-two%2F..'])
+            self.assertEqual(len(app._recording('one')[0]), 1)
+        finally:
+            app.close()
+            shutil.rmtree(app.rec_file)
+
+    def test_flush_unlocked(self):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     rec_namespaces=True)
+        testapp = TestAppPlus(app, session='one')
+        writer = app._recording('one')[1]
+        flush = writer.flush
+        free = []
+
+        def check():
+            # the stripe of the client is released before flushing
+            lock = app.sessions.client_lock('one')
+            thread = threading.Thread(
+                target=lambda: free.append(lock.acquire(False) and
+                                           lock.release() is None))
+            thread.start()
+            thread.join()
+            flush()
+
+        writer.flush = check
+        try:
+            testapp.start_recording()
+            testapp.get('/same')
+            testapp.start_replaying()
+            with testapp.batch():
+                testapp.start_recording()
+                testapp.disable_recording()
+            self.assertEqual(free, [True, True])
+        finally:
+            app.close()
+            shutil.rmtree(app.rec_file)
+
+    def test_limits(self):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     rec_namespaces=True, max_namespaces=3,
+                                     rec_max_open=2)
+        clients = [TestAppPlus(app, session='c%d' % index)
+                   for index in range(6)]
+        first = clients[0]
+        before = set(threading.enumerate())
+        try:
+            first.start_recording()
+            for testapp in clients[1:]:
+                testapp.start_recording()
+                testapp.get('/same')
+                # the namespace in use is never the one evicted
+                first.get('/same')
+            writers = [thread for thread in threading.enumerate()
+                       if thread.name == 'webtestplus-writer' and
+                       thread not in before]
+            self.assertEqual(len(writers), 1)
+            self.assertEqual(list(app._recordings), ['c4', 'c5', 'c0'])
+            first.start_replaying()
+            self.assertTrue(len(app._shared._opened) <= 2)
+
+            app.app = exc.HTTPNotFound()
+            for testapp in clients[1:]:
+                testapp.start_replaying()
+            for testapp in clients:
+                self.assertEqual(testapp.get('/same').body,
+                                 testapp.extra_environ[
+                                     'HTTP_X_TESTING_SESSION'])
+        finally:
+            app.close()
+            shutil.rmtree(app.rec_file)
+
+
+class TestRules(unittest.TestCase):
+
+    def _app(self, environ, start_response):
+        path = environ['PATH_INFO']
+        status = path == '/error' and '500 Error' or '200 OK'
+        start_response(status, [('Content-Type', 'text/plain')])
+        return [path * 10]
+
+    def _check(self, backend=None, format=TEXT):
+        app = ClientTesterMiddleware(self._app, requires_secret=False,
+                                     backend=backend, rec_format=format)
+        testapp = TestAppPlus(app)
+        try:
+            rules = {'include': [{'path': '/api/*'}, {'path': '/error'}],
+                     'exclude': [{'method': 'POST', 'path': '/api/*'}],
+                     'status': ['2xx'], 'max_body': 20, 'dedup': True}
+            self.assertTrue(testapp.start_recording(rules))
+            testapp.get('/api/one')
+            testapp.get('/api/one')
+            testapp.get('/api/two?x')
+            testapp.post('/api/two')
+            testapp.get('/other')
+            testapp.get('/error', status=500)
+            testapp.start_replaying()
+            app.app = exc.HTTPNotFound()
+            resp = testapp.get('/api/one')
+            # /api/one once, and /api/two?x
+            self.assertEqual(len(app.store), 2)
+            self.assertEqual(resp.body, '/api/one/api/one/api')
+            self.assertEqual(resp.headers['X-Webtestplus-Truncated'], '80')
+            testapp.get('/other', status=404)
+
+            # rules are kept by state changes, and replaced with new ones
+            self.assertTrue(testapp.disable_recording())
+            app.app = self._app
+            testapp.start_recording({'include': [{'path': '/big'}],
+                                     'max_body': 5, 'oversize': 'hash'})
+            testapp.get('/api/three')
+            testapp.get('/big')
+            testapp.start_replaying()
+            app.app = exc.HTTPNotFound()
+            resp = testapp.get('/big')
+            self.assertEqual(resp.body, '')
+            self.assertEqual(resp.headers['X-Webtestplus-Length'], '40')
+            self.assertEqual(resp.headers['X-Webtestplus-Body-MD5'],
+                             md5('/big' * 10).hexdigest())
+            testapp.get('/api/three', status=404)
+
+            testapp.post(app.rec_path, params=json.dumps(
+                {'state': 'recording', 'rules': {'sample': 0}}), status=400)
+
+            # rules alone keep the state, which has to be a known one
+            testapp.post(app.rec_path,
+                         params=json.dumps({'rules': {'dedup': True}}))
+            self.assertEqual(testapp.rec_status(), 'playing')
+            testapp.post(app.batch_path, params=json.dumps(
+                [{'op': 'record', 'rules': {'sample': 2}}]))
+            self.assertEqual(testapp.rec_status(), 'playing')
+            for state in ('paused', None, {'state': 'paused'}):
+                testapp.post(app.rec_path, params=json.dumps(state),
+                             status=400)
+            testapp.post(app.batch_path, params=json.dumps(
+                [{'op': 'record', 'state': 5}]), status=400)
+            self.assertEqual(testapp.rec_status(), 'playing')
+        finally:
+            app.close()
+            os.remove(app.rec_file)
+
+    def test_memory(self):
+        self._check()
+
+    def test_binary(self):
+        # the stored length of a capped body is the one in the header
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self._check(format=BINARY)
+        self.assertEqual(caught, [])
+
+    def test_sqlite(self):
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self._check(SQLiteRegistry(filename))
+        finally:
+            os.remove(filename)
+
+    def test_sample(self):
+        keys = [Matcher().digest(str(index)) for index in range(1000)]
+        rules = RecordRules({'sample': 4})
+        picked = [key for key in keys if rules.accepts_request('GET', '/',
+                                                               key)]
+        self.assertTrue(150 < len(picked) < 350)
+        # the same requests are always picked
+        again = RecordRules({'sample': 4})
+        self.assertEqual(picked, [key for key in keys
+                                  if again.accepts_request('GET', '/', key)])
+        for spec in ({'sample': 0}, {'status': ['6xx']}, {'what': 1},
+                     {'include': [{'host': 'x'}]}, {'oversize': 'drop'}):
+            self.assertRaises(ValueError, RecordRules, spec)
+
+
+class TestRecordWriter(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def _read(self):
+        with open(self.filename) as f:
+            return f.read()
+
+    def test_batching(self):
+        writer = RecordWriter(self.filename, flush_interval=60,
+                              batch_size=3)
+        try:
+            writer.write('a')
+            writer.write('b')
+            writer.flush()
+            self.assertEqual(self._read(), 'ab')
+
+            # a full batch is flushed without being asked
+            for data in 'cde':
+                writer.write(data)
+            for i in range(100):
+                if self._read() == 'abcde':
+                    break
+                time.sleep(.01)
+            self.assertEqual(self._read(), 'abcde')
+        finally:
+            writer.close()
+
+    def test_close_drains(self):
+        writer = RecordWriter(self.filename, flush_interval=60,
+                              fsync=True)
+        for i in range(50):
+            writer.write('%d\n' % i)
+        writer.close()
+        self.assertEqual(len(self._read().split()), 50)
+
+        # the writer can be used again after close
+        writer.write('more')
+        writer.close()
+        self.assertTrue(self._read().endswith('more'))
+
+    def test_shared_path(self):
+        # a writer evicted while a body is served writes once more
+        shared = SharedWriter(flush_interval=60)
+        first = RecordWriter(self.filename, shared=shared)
+        first.write('a')
+        first.close()
+        second = RecordWriter(self.filename, shared=shared)
+        second.write('b')
+        first.write('c')
+        flusher = threading.Thread(target=shared.flush)
+        flusher.daemon = True
+        flusher.start()
+        flusher.join(5)
+        # closed only when not stuck
+        self.assertFalse(flusher.is_alive())
+        shared.close()
+        self.assertEqual(sorted(self._read()), ['a', 'b', 'c'])
+
+    def test_failures(self):
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'missing', 'rec')
+        writer = RecordWriter(filename, max_pending=2)
+        self.assertEqual(writer.queue.maxsize, 2)
+        try:
+            body = SpooledTemporaryFile()
+            body.write('x')
+            body.seek(0)
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                writer.write(['a', body])
+                writer.flush()
+            self.assertEqual(writer.errors, 1)
+            self.assertEqual(len(caught), 1)
+            self.assertTrue(body.closed)
+
+            # the writer goes on once the file can be opened
+            os.mkdir(os.path.dirname(filename))
+            writer.write('b')
+            writer.flush()
+            with open(filename) as f:
+                self.assertEqual(f.read(), 'b')
+
+            # a dead thread is started again
+            writer.queue.put(_STOP)
+            writer._thread.join()
+            writer.write('c')
+            writer.flush()
+            with open(filename) as f:
+                self.assertEqual(f.read(), 'bc')
+        finally:
+            writer.close()
+            shutil.rmtree(directory)
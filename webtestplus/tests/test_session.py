@@ -0,0 +1,251 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Tests for webtestplus.session
+"""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import time
+
+from webob import Request
+from webtestplus import ClientTesterMiddleware, TestAppPlus
+from webtestplus.session import SessionRegistry, SQLiteRegistry
+from webtestplus.tests.test_webtestplus import SomeApp
+
+
+class TestSessionRegistry(unittest.TestCase):
+
+    def test_lru(self):
+        sessions = SessionRegistry(max_clients=2)
+        one = sessions.get_or_create('1')
+        sessions.get_or_create('2')
+        self.assertTrue(sessions.get_or_create('1') is one)
+
+        # '1' was used last, but the order is only refreshed
+        # once per second: make it look older
+        one.last_seen -= 2
+        sessions.get('1')
+        sessions.get_or_create('3')
+        self.assertEqual(len(sessions), 2)
+        self.assertTrue(sessions.get('2') is None)
+        self.assertTrue(sessions.get('1') is one)
+
+    def test_ttl(self):
+        sessions = SessionRegistry(ttl=10)
+        session = sessions.get_or_create('1')
+        session.last_seen = time.time() - 11
+        self.assertTrue(sessions.get('1') is None)
+        self.assertEqual(len(sessions), 0)
+
+    def test_passthrough_allocates_nothing(self):
+        app = ClientTesterMiddleware(SomeApp(), requires_secret=False)
+        testapp = TestAppPlus(app)
+        for ip in range(10):
+            testapp.get('/', extra_environ={'REMOTE_ADDR': str(ip)})
+        self.assertEqual(testapp.rec_status(), 'disabled')
+        self.assertEqual(len(app.sessions), 0)
+
+        testapp.mock(503)
+        self.assertEqual(len(app.sessions), 1)
+
+
+class TestConcurrency(unittest.TestCase):
+
+    threads = 64
+
+    def setUp(self):
+        self.app = ClientTesterMiddleware(SomeApp(), requires_secret=False)
+
+    def _run(self, target, *args):
+        errors = []
+
+        def worker(index):
+            try:
+                target(index, *args)
+            except Exception, e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=worker, args=(index,))
+                   for index in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    def _status(self, ip, path='/', **kw):
+        request = Request.blank(path, environ={'REMOTE_ADDR': ip}, **kw)
+        return request.get_response(self.app).status_int
+
+    def test_shared_client(self):
+        # each mock is served exactly once, whatever the contention
+        client = TestAppPlus(self.app,
+                             extra_environ={'REMOTE_ADDR': 'shared'})
+        with client.batch():
+            for i in range(10):
+                client.mock(503, repeat=100)
+        served = []
+
+        def hammer(index):
+            for i in range(30):
+                served.append(self._status('shared'))
+
+        self._run(hammer)
+        self.assertEqual(served.count(503), 1000)
+        self.assertEqual(served.count(200), self.threads * 30 - 1000)
+        self.assertEqual(client.mocks()['length'], 0)
+
+    def test_batch_swap(self):
+        # requests never see a batch half applied
+        environ = {'REMOTE_ADDR': 'swapped'}
+        TestAppPlus(self.app, extra_environ=environ).mock(503, repeat=-1)
+        served = []
+
+        def swap_or_hammer(index):
+            client = TestAppPlus(self.app, extra_environ=environ)
+            for i in range(30):
+                if index % 2:
+                    with client.batch():
+                        client.del_mocks()
+                        client.mock(503 - index % 4, repeat=-1)
+                else:
+                    served.append(self._status('swapped'))
+
+        self._run(swap_or_hammer)
+        self.assertEqual(set(served) - set([500, 502, 503]), set())
+
+    def test_many_clients(self):
+        # clients driving their own mocks and filters concurrently
+        def drive(index):
+            ip = 'client-%d' % index
+            client = TestAppPlus(self.app, extra_environ={'REMOTE_ADDR': ip})
+            for i in range(5):
+                client.mock(400 + index % 5, repeat=3, path='/mocked/*')
+                client.filter({'*': 0})
+                served = [self._status(ip, '/mocked/%d' % i)
+                          for i in range(4)]
+                self.assertEqual(served, [400 + index % 5] * 3 + [200])
+                client.del_filters()
+
+        self._run(drive)
+        self.assertEqual(len(self.app.sessions), self.threads)
+
+
+class TestSQLiteRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'state.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _worker(self):
+        app = ClientTesterMiddleware(SomeApp(), requires_secret=False,
+                                     backend=SQLiteRegistry(self.path))
+        return TestAppPlus(app)
+
+    def test_shared_state(self):
+        # two workers sharing the same database
+        one, two = self._worker(), self._worker()
+        one.get('/', status=200)
+        self.assertEqual(len(one.app.sessions), 0)
+
+        one.mock(503, repeat=2)
+        one.mock(400, repeat=-1)
+        two.get('/', status=503)
+        one.get('/', status=503)
+        two.get('/', status=400)
+        self.assertEqual(one.mocks(),
+                         {'length': 1,
+                          'mocks': [{'status': 400, 'remaining': -1}]})
+        two.del_mocks()
+        one.get('/', status=200)
+
+        two.filter({'*': .5})
+        now = time.time()
+        one.get('/', status=200)
+        self.assertTrue(time.time() - now >= .5)
+        one.del_filters()
+
+        one.start_recording()
+        self.assertEqual(two.rec_status(), 'recording')
+        two.disable_recording()
+        self.assertEqual(one.rec_status(), 'disabled')
+
+        one.mock(503, method='POST', path='/a/*')
+        two.get('/a/b', status=200)
+        two.post('/a/b', status=503)
+
+        with one.batch():
+            one.mock(404)
+            one.start_replaying()
+        self.assertEqual(two.rec_status(), 'playing')
+        two.get('/', status=404)
+
+    def test_empty_pop(self):
+        sessions = SQLiteRegistry(self.path)
+        sessions.get_or_create('1').filters = {'*': .1}
+        transaction = sessions.transaction
+        calls = []
+
+        def counted():
+            calls.append(1)
+            return transaction()
+
+        sessions.transaction = counted
+        session = sessions.get('1')
+        self.assertTrue(session.mocks.pop('GET', '/') is None)
+        self.assertEqual(calls, [])
+
+        # a pushed mock is popped from the same session
+        session.mocks.push({'status': 503})
+        self.assertEqual(session.mocks.pop('GET', '/'), {'status': 503})
+        self.assertEqual(len(calls), 2)
+
+    def test_expiry(self):
+        sessions = SQLiteRegistry(self.path, max_clients=2, ttl=10)
+        sessions.get_or_create('1').mocks.push({'status': 503})
+        sessions.get_or_create('2')
+        sessions.get_or_create('3')
+        self.assertEqual(len(sessions), 2)
+        self.assertTrue(sessions.get('1') is None)
+        self.assertEqual(len(sessions.get_or_create('1').mocks), 0)
+
+        sessions.update('2', 'last_seen', time.time() - 11)
+        self.assertTrue(sessions.get('2') is None)
@@ -35,16 +35,52 @@
 # ***** END LICENSE BLOCK *****
 """ Tests for mozsvc.tests.support
 """
+import json
+import os
+import shutil
+import tempfile
 import unittest
 import time
 
 from webob.dec import wsgify
 from webob import exc
-from webtestplus import ClientTesterMiddleware, TestAppPlus
+from paste.deploy import loadapp
+from webtestplus import (ClientTesterMiddleware, TestAppPlus,
+                         filter_factory, entry_point)
+from webtestplus.driver import LoadDriver
+from webtestplus.metrics import Metrics, PASSTHROUGH
+from webtestplus.mocks import status_line
 from webtestplus.override import DISABLED, RECORD, REPLAY
+from webtestplus.recorder import BINARY
 from webtest.app import AppError
 
 
+INI = """
+[pipeline:main]
+pipeline = testing app
+
+[filter:testing]
+use = call:webtestplus:filter_factory
+secret = xyz
+fast_path = false
+rec_file = %(here)s/recording
+rec_format = binary
+rec_batch_size = 10
+rec_flush_interval = 0.5
+rec_segment_size =
+replay_inline_max = 1024
+backend = sqlite
+backend_path = %(here)s/sessions.db
+max_clients = 50
+client_ttl = 60
+matcher_ignore_params = ts nonce
+matcher_fuzzy = true
+
+[app:app]
+use = call:webtestplus.tests.test_webtestplus:app_factory
+"""
+
+
 class SomeApp(object):
 
     @wsgify
@@ -59,6 +95,10 @@ class SomeApp(object):
         return resp
 
 
+def app_factory(global_conf):
+    return SomeApp()
+
+
 class TestSupport(unittest.TestCase):
 
     def setUp(self):
@@ -110,6 +150,156 @@ class TestSupport(unittest.TestCase):
         then = time.time()
         self.assertTrue(then - now >= .5)
 
+    def test_mock_queue(self):
+        self.assertEqual(self.app.mocks(), {'length': 0, 'mocks': []})
+
+        # a large repeat is stored once
+        self.app.mock(503, repeat=100000)
+        self.app.mock(400, repeat=-1)
+        self.assertEqual(self.app.mocks(),
+                         {'length': 2,
+                          'mocks': [{'status': 503, 'remaining': 100000},
+                                    {'status': 400, 'remaining': -1}]})
+
+        self.app.get('/buh', status=503)
+        self.app.get('/buh', status=503)
+        mocks = self.app.mocks()['mocks']
+        self.assertEqual(mocks[0]['remaining'], 99998)
+
+        self.app.del_mocks()
+        self.app.mock(503, repeat=-1)
+        self.app.mock(400, repeat=2)
+
+        # the infinite mock goes back to the end of the queue
+        for status in (503, 400, 400, 503, 503):
+            self.app.get('/buh', status=status)
+        self.assertEqual(self.app.mocks()['length'], 1)
+
+    def test_compiled_mocks(self):
+        self.app.mock(401, u'caf\xe9', headers={'Content-Type': 'text/plain',
+                                                'X-Count': 1}, repeat=-1)
+        for i in range(2):
+            res = self.app.get('/buh', status=401)
+            self.assertEqual(res.status, '401 Unauthorized')
+            self.assertEqual(res.body, 'caf\xc3\xa9')
+            self.assertEqual(res.headers['Content-Type'], 'text/plain')
+            self.assertEqual(res.headers['X-Count'], '1')
+            self.assertEqual(res.content_length, 5)
+        self.assertEqual(status_line(599), '599 Internal Server Error')
+
+        # invalid mocks are refused when pushed
+        self.app.del_mocks()
+        for spec in ({'status': 'oops'}, {'status': 99}, {'body': [1]},
+                     {'headers': ['a']}, {'repeat': 'x'}, {'repeat': -2},
+                     {'method': 5}, {'path': 5}):
+            self.app.post('/__testing__', params=json.dumps(spec),
+                          status=400)
+        self.assertEqual(self.app.mocks()['length'], 0)
+
+    def test_routed_mocks(self):
+        self.app.mock(503, method='GET', path='/storage/*', repeat=2)
+        self.app.mock(200, 'info', method='POST', path='/info')
+        self.app.mock(404, path='/a/*/c')
+
+        self.app.get('/info', status=200)
+        self.assertEqual(self.app.get('/buh').body, 'ok')
+        self.app.post('/storage/x', status=200)
+        self.assertEqual(self.app.post('/info').body, 'info')
+        self.app.get('/storage/x/y', status=503)
+        self.app.get('/storage', status=200)
+        self.app.get('/a/b/c', status=404)
+        self.app.get('/a/b/c/d', status=200)
+        self.app.get('/storage/z', status=503)
+        self.app.get('/storage/z', status=200)
+        self.assertEqual(self.app.mocks()['length'], 0)
+
+        # the oldest matching mock wins
+        self.app.mock(500, path='/x', repeat=-1)
+        self.app.mock(501)
+        self.app.mock(502, path='/*')
+        self.app.get('/x', status=500)
+        self.app.get('/x', status=501)
+        self.app.get('/x', status=502)
+        self.app.get('/x', status=500)
+        self.app.get('/y', status=200)
+        self.assertEqual(self.app.mocks()['mocks'],
+                         [{'status': 500, 'remaining': -1, 'path': '/x'}])
+
+    def test_batch(self):
+        with self.app.batch():
+            self.app.mock(503, repeat=2)
+            self.app.mock(400)
+            self.app.filter({400: .5})
+            self.app.start_recording()
+            # nothing was sent yet
+            self.assertEqual(self.app.mocks()['length'], 0)
+
+        self.assertEqual(self.app.mocks()['length'], 2)
+        self.assertEqual(self.app.rec_status(), RECORD)
+        self.app.get('/buh', status=503)
+        self.app.get('/buh', status=503)
+        now = time.time()
+        self.app.get('/buh', status=400)
+        self.assertTrue(time.time() - now >= .5)
+
+        with self.app.batch():
+            self.app.del_mocks()
+            self.app.del_filters()
+            self.app.disable_recording()
+            self.app.mock(404)
+        self.app.get('/buh', status=404)
+        self.assertEqual(self.app.rec_status(), DISABLED)
+
+        # a bad operation: nothing is applied
+        ops = '[{"op": "mock", "status": 503}, {"op": "explode"}]'
+        self.app.post('/__batch__', params=ops, status=400)
+        self.assertEqual(self.app.mocks()['length'], 0)
+
+    def test_metrics(self):
+        # disabled by default
+        self.assertEqual(self.app.metrics(), {'requests': {}, 'stages': {}})
+
+        app = ClientTesterMiddleware(SomeApp(), requires_secret=False,
+                                     metrics=True)
+        self.app = TestAppPlus(app, extra_environ={'REMOTE_ADDR': 'me'})
+        self.app.get('/buh')
+        self.app.mock(503)
+        self.app.get('/buh', status=503)
+        self.app.start_recording()
+        self.app.get('/buh')
+        self.app.start_replaying()
+        self.app.get('/buh')
+        self.app.get('/bah')
+
+        metrics = self.app.metrics()
+        self.assertEqual(metrics['requests']['me'],
+                         {'passthrough': 1, 'mock_hit': 1, 'recorded': 1,
+                          'replay_hit': 1, 'replay_miss': 1})
+        request = metrics['stages']['request']['replay_hit']
+        self.assertEqual(request['count'], 1)
+        self.assertEqual(request['buckets'][-1], ['+Inf', 1])
+        self.assertEqual(metrics['stages']['app']['replay_miss']['count'], 1)
+        self.assertTrue('load' in metrics['stages'])
+
+        text = self.app.get('/__metrics__?format=prometheus')
+        self.assertEqual(text.content_type, 'text/plain')
+        self.assertTrue('webtestplus_requests_total{client="me",'
+                        'outcome="mock_hit"} 1\n' in text.body)
+        self.assertTrue('webtestplus_stage_seconds_count{stage="replay",'
+                        'outcome="replay_hit"} 1\n' in text.body)
+
+        self.app.del_metrics()
+        self.assertEqual(self.app.metrics(), {'requests': {}, 'stages': {}})
+        app.close()
+
+        # the least recently seen clients are folded together
+        metrics = Metrics(max_clients=2)
+        for client in 'abacd':
+            metrics.count(client, PASSTHROUGH)
+        self.assertEqual(metrics.as_dict()['requests'],
+                         {'c': {'passthrough': 1}, 'd': {'passthrough': 1},
+                          '*': {'passthrough': 3}})
+
     def test_filtering(self):
         # we want to add .5 delays for *all* requests
         self.app.filter({'*': .5})
@@ -144,6 +334,112 @@ class TestSupport(unittest.TestCase):
         then = time.time()
         self.assertTrue(then - now < .5)
 
+    def test_deferred_delay(self):
+        slept = []
+        app = ClientTesterMiddleware(SomeApp(), requires_secret=False,
+                                     sleep=slept.append)
+        testapp = TestAppPlus(app,
+                              extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+        testapp.filter({'*': 5})
+        testapp.mock(503, delay=2)
+
+        # the middleware returns without waiting, the delays
+        # are served while the body is iterated
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/buh',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http', 'REMOTE_ADDR': '127.0.0.1'}
+        app_iter = app(environ, lambda status, headers: None)
+        self.assertEqual(slept, [])
+
+        list(app_iter)
+        self.assertEqual(len(slept), 1)
+        self.assertTrue(6.9 < slept[0] <= 7)
+
+    def test_shaping(self):
+        now = [1000.]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        def big(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return ['x' * 4096, 'y' * 4096]
+
+        app = ClientTesterMiddleware(big, requires_secret=False,
+                                     sleep=sleep, shaping_seed=1)
+        app.scheduler.clock = lambda: now[0]
+        testapp = TestAppPlus(app,
+                              extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/buh',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http', 'REMOTE_ADDR': '127.0.0.1'}
+
+        # 1s to the first byte, then 1KB/s once the burst is spent
+        testapp.filter({'*': {'delay': 1, 'rate': 1024, 'chunk': 512}})
+        app_iter = app(dict(environ), lambda status, headers: None)
+        self.assertEqual(slept, [])
+        chunks = list(app_iter)
+        self.assertEqual(len(chunks), 16)
+        self.assertEqual(''.join(chunks), 'x' * 4096 + 'y' * 4096)
+        self.assertAlmostEqual(now[0], 1008.)
+
+        # jitter and failures
+        testapp.filter({'*': {'jitter': 2, 'distribution': 'exponential',
+                              'error_rate': 1, 'error_status': 502}})
+        del slept[:]
+        testapp.get('/buh', status=502)
+        self.assertTrue(len(slept) == 1 and slept[0] > 0)
+
+        testapp.filter({'*': {'error_rate': 0}})
+        self.assertEqual(testapp.get('/buh').body, 'x' * 4096 + 'y' * 4096)
+
+        for spec in ({'rate': -1}, {'distribution': 'pareto'},
+                     {'error_rate': 2}, {'bandwidth': 1}, 'slow', -1, None,
+                     True):
+            testapp.post('/__filter__', params=json.dumps({'*': spec}),
+                         status=400)
+
+    def test_load_driver(self):
+        app = ClientTesterMiddleware(SomeApp(), requires_secret=False)
+        driver = LoadDriver(app, clients=20, threads=4)
+        driver.setup(lambda client: client.index % 2 and
+                     client.mock(503, repeat=-1))
+
+        report = driver.run(requests=200)
+        self.assertEqual(report['requests'], 200)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(report['statuses'], {200: 100, 503: 100})
+        self.assertTrue(report['p50'] <= report['p99'] <= report['p100'])
+        self.assertEqual(len(app.sessions), 10)
+
+        driver.reset()
+        report = driver.run(duration=.1)
+        self.assertEqual(report['statuses'].keys(), [200])
+
+    def test_fast_path(self):
+        body = ['a', 'b']
+
+        def bare(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return body
+
+        app = ClientTesterMiddleware(bare, requires_secret=False)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/buh',
+                   'SERVER_NAME': 'localhost', 'SERVER_PORT': '80',
+                   'wsgi.url_scheme': 'http', 'REMOTE_ADDR': '127.0.0.1'}
+
+        # the app's iterable is returned untouched
+        self.assertTrue(app(dict(environ), lambda *args: None) is body)
+
+        # but not when the client has set something up
+        testapp = TestAppPlus(app,
+                              extra_environ={'REMOTE_ADDR': '127.0.0.1'})
+        testapp.mock(503)
+        self.assertFalse(app(dict(environ), lambda *args: None) is body)
+        self.assertTrue(app(dict(environ), lambda *args: None) is body)
+
     def test_rec_flag(self):
         self.assertEquals(self.app.rec_status(), DISABLED)
 
@@ -190,6 +486,40 @@ class TestSupport(unittest.TestCase):
         finally:
             SomeApp.__call__ = old
 
+    def test_filter_factory(self):
+        directory = tempfile.mkdtemp()
+        ini = os.path.join(directory, 'test.ini')
+        with open(ini, 'w') as f:
+            f.write(INI % {'here': directory})
+        try:
+            app = loadapp('config:' + ini, name='main')
+            self.assertTrue(isinstance(app, ClientTesterMiddleware))
+            self.assertEqual(app.secret, 'xyz')
+            self.assertFalse(app.fast_path)
+            self.assertEqual(app.writer.batch_size, 10)
+            self.assertEqual(app.writer.flush_interval, .5)
+            self.assertEqual(app.rec_format, BINARY)
+            self.assertEqual(app.store.inline_max, 1024)
+            self.assertEqual(app.sessions.max_clients, 50)
+            self.assertEqual(app.sessions.ttl, 60)
+            self.assertEqual(app.sessions.path,
+                             os.path.join(directory, 'sessions.db'))
+            self.assertEqual(app.matcher.ignore_params,
+                             frozenset(['ts', 'nonce']))
+            self.assertTrue(app.matcher.fuzzy)
+            app.close()
+
+            self.assertRaises(ValueError, filter_factory, {}, max_client='1')
+            self.assertRaises(ValueError, filter_factory, {},
+                              backend='sqlite')
+            app = entry_point(SomeApp(), {}, recfile=ini + '.rec',
+                              requires_secret='false')
+            self.assertEqual(app.rec_file, ini + '.rec')
+            self.assertEqual(TestAppPlus(app).get('/').body, 'ok')
+            app.close()
+        finally:
+            shutil.rmtree(directory)
+
     def test_auth(self):
         # secret activated by default
         oapp = ClientTesterMiddleware(SomeApp())
@@ -203,3 +533,38 @@ class TestSupport(unittest.TestCase):
         app = TestAppPlus(oapp, secret='CHANGEME')
         app.get('/', status=200)
         self._run_session(app)
+
+    def test_binary_session(self):
+        app = ClientTesterMiddleware(SomeApp(), requires_secret=False,
+                                     rec_format=BINARY, rec_compress=True)
+        self._run_session(TestAppPlus(app))
+
+    def test_replay_sequence(self):
+        polls = []
+
+        @wsgify
+        def status(request):
+            polls.append(1)
+            return 'poll %d' % len(polls)
+
+        app = ClientTesterMiddleware(status, requires_secret=False)
+        testapp = TestAppPlus(app)
+        other = TestAppPlus(app, extra_environ={'REMOTE_ADDR': '10.0.0.1'})
+        testapp.start_recording()
+        for i in range(3):
+            testapp.get('/status')
+
+        testapp.start_replaying()
+        other.start_replaying()
+        for i in (1, 2, 3, 3):
+            self.assertEqual(testapp.get('/status').body, 'poll %d' % i)
+        # each client has its own cursor
+        self.assertEqual(other.get('/status').body, 'poll 1')
+
+        testapp.start_replaying()
+        self.assertEqual(testapp.get('/status').body, 'poll 1')
+        self.assertEqual(len(polls), 3)
+
+        app.store.wrap = True
+        for i in (2, 3, 1):
+            self.assertEqual(testapp.get('/status').body, 'poll %d' % i)
@@ -0,0 +1,496 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1/GPL 2.0/LGPL 2.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Sync Server
+#
+# The Initial Developer of the Original Code is the Mozilla Foundation.
+# Portions created by the Initial Developer are Copyright (C) 2010
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#   Tarek Ziade (tarek@mozilla.com)
+#
+# Alternatively, the contents of this file may be used under the terms of
+# either the GNU General Public License Version 2 or later (the "GPL"), or
+# the GNU Lesser General Public License Version 2.1 or later (the "LGPL"),
+# in which case the provisions of the GPL or the LGPL are applicable instead
+# of those above. If you wish to allow use of your version of this file only
+# under the terms of either the GPL or the LGPL, and not to allow others to
+# use your version of this file under the terms of the MPL, indicate your
+# decision by deleting the provisions above and replace them with the notice
+# and other provisions required by the GPL or the LGPL. If you do not delete
+# the provisions above, a recipient may use your version of this file under
+# the terms of any one of the MPL, the GPL or the LGPL.
+#
+# ***** END LICENSE BLOCK *****
+""" Recording writer
+"""
+import atexit
+import os
+import shutil
+import threading
+import time
+import Queue
+from collections import OrderedDict
+from tempfile import SpooledTemporaryFile
+from warnings import warn
+
+try:
+    import fcntl
+except ImportError:     # no file locking on this platform
+    fcntl = None
+
+__all__ = ['RecordWriter', 'SegmentedWriter', 'SharedWriter', 'TeeIter']
+
+
+_STOP = object()
+_CLOSE = object()
+
+
+class _Flush(object):
+    def __init__(self):
+        self.done = threading.Event()
+
+
+def _discard(data):
+    if isinstance(data, str):
+        return
+    for piece in data:
+        if not isinstance(piece, str):
+            piece.close()
+
+
+class RecordWriter(object):
+    """Appends serialized exchanges to a file from a single thread.
+
+    Request threads only enqueue their data. The writer thread keeps the
+    file open and flushes it every batch_size records, or flush_interval
+    seconds after the first unflushed one, whichever comes first. When
+    fsync is True, each flush is also synced to the disk.
+
+    The thread is started on the first write and drained by close(),
+    which also runs at interpreter exit. Each batch is written under an
+    exclusive lock of the file, so several processes can record in it.
+
+    At most max_pending records wait for the thread: beyond, write()
+    blocks until the disk catches up. A record that cannot be written is
+    dropped with a warning, counted in errors, and the file is opened
+    again for the next one.
+
+    With shared, a SharedWriter, the records are written by its thread
+    instead, which keeps the file open only while it is among the most
+    recently written to.
+    """
+    def __init__(self, filename, flush_interval=1., batch_size=100,
+                 fsync=False, max_pending=1000, shared=None):
+        self.filename = filename
+        self.shared = shared
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.queue = Queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.error = None
+        self._thread = None
+        self._registered = False
+        self._file = None
+        self._locked = False
+
+    def _start(self):
+        with self.lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            # started again if it died
+            self._thread = threading.Thread(target=self._run,
+                                            name='webtestplus-writer')
+            self._thread.daemon = True
+            self._thread.start()
+            if not self._registered:
+                atexit.register(self.close)
+                self._registered = True
+
+    def write(self, data, key=None):
+        """Enqueues data to be appended to the file.
+
+        data is a string or a list of pieces: strings, or files which are
+        copied chunk by chunk, then closed. key is the digest of the
+        recorded request, used by writers that index what they write.
+        """
+        owner = self.shared or self
+        thread = owner._thread
+        if thread is None or not thread.is_alive():
+            owner._start()
+        owner.queue.put((self, data, key))
+
+    def flush(self):
+        """Blocks until the data enqueued so far is written."""
+        if self.shared is not None:
+            return self.shared.flush()
+        thread = self._thread
+        if thread is None:
+            return
+        request = _Flush()
+        self.queue.put(request)
+        while not request.done.wait(1):
+            if not thread.is_alive():
+                # the writer thread failed
+                return
+
+    def close(self):
+        """Writes everything that is pending and stops the thread."""
+        if self.shared is not None:
+            return self.shared.release(self)
+        with self.lock:
+            thread, self._thread = self._thread, None
+            if thread is None or not thread.is_alive():
+                return
+            self.queue.put(_STOP)
+        thread.join()
+
+    def _open(self):
+        self._file = open(self.filename, 'ab')
+
+    def _close(self):
+        self._flush()
+        self._file.close()
+        self._file = None
+
+    def _flush(self):
+        f = self._file
+        f.flush()
+        if self.fsync:
+            os.fsync(f.fileno())
+        if self._locked:
+            fcntl.flock(f, fcntl.LOCK_UN)
+            self._locked = False
+
+    def _abort(self):
+        f, self._file = self._file, None
+        self._locked = False
+        if f is not None:
+            try:
+                f.close()
+            except EnvironmentError:
+                pass
+
+    def _failed(self, error):
+        # the writer goes on, the file is opened again for the next record
+        self.errors += 1
+        self.error = error
+        warn('Failed to record in %s: %s' % (self.filename, error))
+        self._abort()
+
+    def _record(self, data, key=None):
+        try:
+            if self._file is None:
+                self._open()
+            self._write(data, key)
+        except EnvironmentError, e:
+            self._failed(e)
+            _discard(data)
+            return False
+        return True
+
+    def _safe_flush(self):
+        if self._file is None:
+            return
+        try:
+            self._flush()
+        except EnvironmentError, e:
+            self._failed(e)
+
+    def _safe_close(self):
+        if self._file is None:
+            return
+        try:
+            self._close()
+        except EnvironmentError, e:
+            self._failed(e)
+
+    def _write(self, data, key=None):
+        f = self._file
+        if fcntl is not None and not self._locked:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self._locked = True
+
+        if isinstance(data, str):
+            f.write(data)
+            return
+
+        for piece in data:
+            if isinstance(piece, str):
+                f.write(piece)
+            else:
+                try:
+                    shutil.copyfileobj(piece, f)
+                finally:
+                    piece.close()
+
+    def _dispatch(self, writer, data, key):
+        if data is _CLOSE:
+            writer._safe_close()
+            return False
+        return writer._record(data, key)
+
+    def _flush_all(self):
+        self._safe_flush()
+
+    def _close_all(self):
+        self._safe_close()
+
+    def _run(self):
+        pending = 0
+        first = None
+
+        try:
+            while True:
+                if pending:
+                    timeout = first + self.flush_interval - time.time()
+                    try:
+                        item = self.queue.get(timeout=max(timeout, 0))
+                    except Queue.Empty:
+                        item = None
+                else:
+                    item = self.queue.get()
+
+                if item is _STOP:
+                    return
+
+                if isinstance(item, _Flush):
+                    self._flush_all()
+                    pending, first = 0, None
+                    item.done.set()
+                    continue
+
+                if item is not None and self._dispatch(*item):
+                    pending += 1
+                    if first is None:
+                        first = time.time()
+
+                if pending and (item is None or pending >= self.batch_size):
+                    self._flush_all()
+                    pending, first = 0, None
+        finally:
+            self._close_all()
+
+
+INDEX_SUFFIX = '.idx'
+SEGMENT_SUFFIX = '.rec'
+
+
+def segments(directory):
+    """Returns the paths of the segments in directory, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)
+            if name.endswith(SEGMENT_SUFFIX)]
+
+
+class SegmentedWriter(RecordWriter):
+    """RecordWriter appending to segment files in a directory.
+
+    A new segment is started once the current one holds segment_size
+    bytes, or was started segment_age seconds ago. Beyond keep_segments
+    segments, or keep_bytes bytes in total, the oldest ones are deleted.
+
+    Each segment has a sidecar index: a signature line identifying how
+    the digests were computed, then a "digest offset length" line per
+    record written with a key. Index lines are written after the data
+    they point to is flushed.
+    """
+    def __init__(self, directory, flush_interval=1., batch_size=100,
+                 fsync=False, segment_size=None, segment_age=None,
+                 keep_segments=None, keep_bytes=None, signature='',
+                 max_pending=1000, shared=None):
+        super(SegmentedWriter, self).__init__(directory, flush_interval,
+                                              batch_size, fsync, max_pending,
+                                              shared)
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.keep_segments = keep_segments
+        self.keep_bytes = keep_bytes
+        self.signature = signature
+        self.path = None
+        self._index = None
+        self._entries = []
+        self._started = None
+
+    def _next_path(self):
+        last = segments(self.filename)
+        number = 0
+        if last:
+            number = int(os.path.basename(last[-1]).split('-', 1)[0]) + 1
+        # the pid keeps processes recording in the same directory apart
+        name = '%010d-%d%s' % (number, os.getpid(), SEGMENT_SUFFIX)
+        return os.path.join(self.filename, name)
+
+    def _open(self):
+        if not os.path.isdir(self.filename):
+            os.makedirs(self.filename)
+        self.path = self._next_path()
+        self._index = open(self.path + INDEX_SUFFIX, 'ab')
+        self._index.write(self.signature + '\n')
+        self._file = open(self.path, 'ab')
+        self._started = time.time()
+        self._prune()
+
+    def _close(self):
+        super(SegmentedWriter, self)._close()
+        self._index.close()
+        self._index = None
+
+    def _abort(self):
+        # what follows goes to a new segment
+        super(SegmentedWriter, self)._abort()
+        self._entries = []
+        if self._index is not None:
+            try:
+                self._index.close()
+            except EnvironmentError:
+                pass
+            self._index = None
+
+    def _flush(self):
+        super(SegmentedWriter, self)._flush()
+        if self._entries:
+            self._index.write(''.join(self._entries))
+            self._entries = []
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._index.fileno())
+
+    def _write(self, data, key=None):
+        f = self._file
+        start = f.tell()
+        super(SegmentedWriter, self)._write(data, key)
+        end = f.tell()
+        if key is not None:
+            self._entries.append('%s %d %d\n' % (key, start, end - start))
+
+        if (self.segment_size is not None and end >= self.segment_size) or \
+                (self.segment_age is not None and
+                 time.time() - self._started >= self.segment_age):
+            self._close()
+            self._open()
+
+    def _prune(self):
+        paths = segments(self.filename)
+        sizes = [os.path.getsize(path) for path in paths]
+        while len(paths) > 1:
+            if (self.keep_segments is None or
+                    len(paths) <= self.keep_segments) and \
+                    (self.keep_bytes is None or sum(sizes) <= self.keep_bytes):
+                break
+            path = paths.pop(0)
+            sizes.pop(0)
+            for name in path, path + INDEX_SUFFIX:
+                try:
+                    os.remove(name)
+                except OSError:
+                    pass
+
+
+class SharedWriter(RecordWriter):
+    """A writer thread for many RecordWriter or SegmentedWriter created
+    with it as their shared argument.
+
+    Their files are kept open for at most max_open of them: the least
+    recently written to is flushed and closed first, and opened again by
+    its next record. A segmented writer then starts a new segment.
+    """
+    def __init__(self, flush_interval=1., batch_size=100, max_pending=1000,
+                 max_open=32):
+        super(SharedWriter, self).__init__(None, flush_interval, batch_size,
+                                           max_pending=max_pending)
+        self.max_open = max_open
+        self._opened = OrderedDict()
+
+    def release(self, writer):
+        """Closes the file of writer once its records are written."""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self.queue.put((writer, _CLOSE, None))
+
+    def _dispatch(self, writer, data, key):
+        opened = self._opened
+        path = writer.filename
+        if data is _CLOSE:
+            if opened.get(path) is writer:
+                del opened[path]
+        else:
+            current = opened.pop(path, None)
+            if current is not None and current is not writer:
+                # a writer holds the lock of its file until it flushes:
+                # a file is only open for one writer at a time
+                current._safe_close()
+            while current is None and len(opened) >= self.max_open:
+                opened.popitem(last=False)[1]._safe_close()
+            # the most recently written to come last
+            opened[path] = writer
+        return super(SharedWriter, self)._dispatch(writer, data, key)
+
+    def _flush_all(self):
+        for writer in self._opened.values():
+            writer._safe_flush()
+
+    def _close_all(self):
+        while self._opened:
+            self._opened.popitem()[1]._safe_close()
+
+
+class TeeIter(object):
+    """Wraps an app_iter and copies its chunks to a spooled file as they
+    are served.
+
+    Once the body was fully served and the iterator is closed,
+    callback(body, length) is called with the file rewound: it then owns
+    it. length is the size of the whole body, of which at most limit
+    bytes are copied, and which is fed to hasher if given. If the body
+    was not fully served, the copy is dropped.
+    """
+    def __init__(self, app_iter, callback, spool_size=1024 * 1024,
+                 limit=None, hasher=None):
+        self.app_iter = app_iter
+        self.callback = callback
+        self.spool = SpooledTemporaryFile(max_size=spool_size)
+        self.limit = limit
+        self.hasher = hasher
+        self.length = 0
+        self._done = False
+
+    def __iter__(self):
+        limit, hasher = self.limit, self.hasher
+        for chunk in self.app_iter:
+            if limit is None:
+                self.spool.write(chunk)
+            elif self.length < limit:
+                self.spool.write(chunk[:limit - self.length])
+            if hasher is not None:
+                hasher.update(chunk)
+            self.length += len(chunk)
+            yield chunk
+        self._done = True
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if self._done:
+                self.spool.seek(0)
+                self.callback(self.spool, self.length)
+            else:
+                self.spool.close()